@@ -1,9 +1,21 @@
 """
 Module for manageing crontabs interface
 """
+from collections import Counter, defaultdict
+import copy
+import cProfile
+import ctypes
 import datetime
 import functools
+import multiprocessing
+import os
+import pickle
+import re
+import runpy
+import signal
 import time
+import tracemalloc
+import zlib
 import traceback
 import warnings
 
@@ -11,43 +23,414 @@ import daiquiri
 from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from fleming import fleming
-from .processes import ProcessMonitor
+from .partitions import PartitionError, PartitionMap
+from .processes import AdmissionController, ProcessMonitor
+from .timezones import from_seconds, get_offset_table, get_timezone, to_seconds
+from .triggers import DirectoryTrigger, FileTrigger, QueueTrigger, coalesce
 
 import logging
 daiquiri.setup(level=logging.INFO)
 
 
+def load_tabs(path):
+    """
+    Default loader for Cron.watch().  Executes the python file at path and returns
+    the iterable of tabs it assigns to a module-level variable named "tabs".
+    """
+    namespace = runpy.run_path(path)
+    if 'tabs' not in namespace:
+        raise ValueError('Config file {} must define a variable named "tabs"'.format(path))
+    return namespace['tabs']
+
+
+class ConfigWatcher:
+    def __init__(self, cron, path, loader=load_tabs, interval_seconds=1):
+        """
+        Reloads the tabs of a cron whenever the config file at path changes.
+        :param cron: The Cron instance to reload
+        :param path: Path to the config file
+        :param loader: A callable taking path and returning an iterable of tabs
+        :param interval_seconds: Minimum seconds between checks of the file
+        """
+        self._cron = cron
+        self._path = path
+        self._loader = loader
+        self._interval_seconds = interval_seconds
+        self._last_checked = None
+        self._last_mtime = None
+
+    def __call__(self):
+        now = time.time()
+        if self._last_checked is not None and now - self._last_checked < self._interval_seconds:
+            return
+        self._last_checked = now
+
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except OSError:
+            return
+        if mtime == self._last_mtime:
+            return
+        self._last_mtime = mtime
+
+        try:
+            self._cron.reload(*self._loader(self._path))
+        except:  # noqa  a broken config file must never take down the running tabs
+            s = 'Error loading {}\n'.format(self._path) + traceback.format_exc()
+            Cron.get_logger().error(s)
+
+
 class Cron:
+    # Sending this signal to the parent process profiles the next run of every profiled tab
+    PROFILE_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
     @classmethod
     def get_logger(self, name='crontab_log'):
         logger = daiquiri.getLogger(name)
         return logger
 
-    def __init__(self):
+    def __init__(self, max_concurrent_runs=None, priorities=None):
         """
         A Cron object runs many "tabs" of asynchronous tasks.
+        :param max_concurrent_runs: If set, at most this many tab runs execute at the same
+                                    time.  Other runs wait their turn.
+        :param priorities: A dict mapping tab names to priorities used to order waiting runs.
+                           Lower values run first.  Unlisted tabs have priority 0.
         """
         self.monitor = ProcessMonitor()
+        self.monitor.add_event_handler(self._handle_event)
         self._tab_list = []
+        # maps upstream tab names to the tabs that run after them
+        self._downstream = defaultdict(list)
+        # (template, params_iterable) pairs added with .schedule_many()
+        self._bulk_list = []
+        self._stats = defaultdict(Counter)
+        self._priorities = priorities or {}
+        self._profile_signal_installed = False
+        self._admission = None
+        if max_concurrent_runs is not None:
+            self._admission = AdmissionController(max_concurrent_runs)
+            self.monitor.add_event_handler(self._admission.handle_event)
 
     def schedule(self, *tabs):
         self._tab_list = list(tabs)
+        self._downstream.clear()
+        for tab in tabs:
+            self._link(tab)
         return self
 
+    def schedule_many(self, template, params_iterable):
+        """
+        Schedule one tab for every item of params_iterable without building a Tab object for
+        each.  The template is a tab whose name is a format string.  Every item is a dict used
+        to fill in the name and merged into the keyword arguments of the template function.
+        The iterable is consumed lazily when the cron starts, and each tab process gets the
+        shared template plus its own parameters.  Where processes are not forked, the template
+        is pickled, so its functions can't be lambdas or local functions.  Tabs created this
+        way can't be removed or reloaded individually, and they only pass results downstream
+        if a tab using .after(..., pass_result=True) is scheduled when the cron starts.
+
+        :param template: A Tab like Tab('export_{customer}').every(hours=1).run(export)
+        :param params_iterable: An iterable of dicts like ({'customer': c} for c in customers)
+        :return: self
+        """
+        for unsupported in ['_profile_runs', '_recycle_event', '_trigger_spec']:
+            if getattr(template, unsupported) is not None:
+                raise ValueError('Templates can not use profile, max_rss_mb or triggers')
+        if template._on_demand or template._after_names:
+            raise ValueError('Templates can not use on_demand or .after()')
+        if not _forks_processes():
+            try:
+                pickle.dumps(template)
+            except Exception as error:
+                raise ValueError(
+                    'Templates must be picklable where processes are not forked.  Use module level '
+                    'functions instead of lambdas or local functions: {!r}'.format(error))
+        self._bulk_list.append((template, params_iterable))
+        if self.monitor.is_running:
+            self._register_many(template, params_iterable)
+        return self
+
+    def add(self, tab):
+        """
+        Add a tab to the cron.  If the cron is already running, the tab is started
+        right away without disturbing any of the other tabs.
+        """
+        if tab._name in {t._name for t in self._tab_list}:
+            raise ValueError('A tab named {} is already scheduled'.format(tab._name))
+        self._validate(tab)
+        self._tab_list.append(tab)
+        self._link(tab)
+        if self.monitor.is_running:
+            self._register(tab)
+            if tab._pass_result:
+                self._start_sending_results(tab._after_names)
+        return self
+
+    def remove(self, name):
+        """
+        Remove the tab with the given name, stopping its process if it is running.
+        """
+        removed = [t for t in self._tab_list if t._name == name]
+        if not removed:
+            raise ValueError('No tab named {} is scheduled'.format(name))
+        self._tab_list = [t for t in self._tab_list if t._name != name]
+        self._unlink(removed[0])
+        self.monitor.remove_subprocess(name)
+        return self
+
+    def reload(self, *tabs):
+        """
+        Make the scheduled tabs match the ones supplied.  New tabs are started, missing
+        tabs are stopped and tabs whose definition changed are restarted.  Tabs that
+        are unchanged keep running untouched.  If any of the tabs is invalid, nothing
+        is changed.
+        """
+        desired = {}
+        for tab in tabs:
+            if tab._name in desired:
+                raise ValueError('Tab name {} appears more than once'.format(tab._name))
+            self._validate(tab)
+            desired[tab._name] = tab
+
+        current = {t._name: t for t in self._tab_list}
+        for name in current:
+            if name not in desired:
+                self.remove(name)
+
+        for name, tab in desired.items():
+            if name in current:
+                if current[name]._fingerprint() == tab._fingerprint():
+                    continue
+                self.remove(name)
+            self.add(tab)
+        return self
+
+    def watch(self, path, loader=load_tabs, interval_seconds=1):
+        """
+        Keep the scheduled tabs in sync with a config file while the cron is running.
+        The file is loaded when the cron starts and again whenever it is modified.
+
+        :param path: Path to the config file
+        :param loader: A callable taking path and returning an iterable of tabs.  The
+                       default executes path as python and reads its "tabs" variable.
+        :param interval_seconds: Minimum seconds between checks of the file
+        """
+        self.monitor.add_hook(ConfigWatcher(self, path, loader, interval_seconds))
+        return self
+
+    def profile(self, name=None, runs=1):
+        """
+        Profile the next runs of tabs that were created with a profile argument.
+        :param name: Only profile the tab with this name.  Defaults to all profiled tabs.
+        :param runs: The number of upcoming runs to profile
+        """
+        tabs = [t for t in self._tab_list if t._profile_runs is not None and name in (None, t._name)]
+        if name is not None and not tabs:
+            raise ValueError('No tab named {} was created with a profile argument'.format(name))
+        for tab in tabs:
+            tab.profile_next(runs)
+        return self
+
+    def _handle_profile_signal(self, signum, frame):  # pragma: no cover
+        self.profile()
+
+    def _install_profile_signal(self):
+        if self.PROFILE_SIGNAL is None or self._profile_signal_installed:
+            return
+        try:
+            signal.signal(self.PROFILE_SIGNAL, self._handle_profile_signal)
+        except ValueError:  # pragma: no cover  signals can only be set from the main thread
+            return
+        self._profile_signal_installed = True
+
+    def stats(self):
+        """
+        Returns a dict mapping tab names to counts of their successful runs, failed
+        runs and retries seen while the cron was running.
+        """
+        return {name: dict(counts) for (name, counts) in self._stats.items()}
+
+    def _handle_event(self, kind, name, payload):
+        if kind in ('success', 'failure', 'retry'):
+            self._stats[name][kind] += 1
+        if kind != 'success':
+            return
+        for tab in self._downstream.get(name, ()):
+            if self.monitor.has_one_shot(tab._name):
+                tab._log('Skipping trigger from {} because the previous run is still going'.format(name))
+                continue
+            self.monitor.run_once(tab._name, tab._get_trigger_target(payload), tab._robust)
+
+    def _link(self, tab):
+        for name in tab._after_names:
+            self._downstream[name].append(tab)
+
+    def _unlink(self, tab):
+        for name in tab._after_names:
+            self._downstream[name].remove(tab)
+            if not self._downstream[name]:
+                del self._downstream[name]
+
+    def _consumes_results(self, name):
+        return any(t._pass_result for t in self._downstream.get(name, ()))
+
+    def _start_sending_results(self, names):
+        """
+        Make running upstream tabs send their results now that a downstream tab uses them.
+        The flag is shared with their processes, so they don't need to be restarted.
+        """
+        for tab in self._tab_list:
+            if tab._name in names and tab._send_result is not None:
+                tab._send_result.value = True
+
+    def _validate(self, tab):
+        """
+        Raises the errors registering tab would raise, so they surface before anything is changed
+        """
+        if tab._every_kwargs is None and tab._trigger_spec is None and tab._after_names:
+            tab._prepare_triggered()
+        else:
+            tab._get_target()
+
+    def _register(self, tab):
+        tab._event_queue = self.monitor.q_event
+        tab._send_result = multiprocessing.RawValue(ctypes.c_bool, self._consumes_results(tab._name))
+        if tab._profile_runs is not None:
+            # tabs added while running need the signal as much as the ones scheduled up front
+            self._install_profile_signal()
+        if self._admission is not None:
+            tab._admission_event = self._admission.grant_event(tab._name)
+            tab._one_shot_admission_event = self._admission.grant_event(tab._name, one_shot=True)
+            tab._priority = self._priorities.get(tab._name, 0)
+        if tab._allow_children:
+            self.monitor.allow_children(tab._name)
+        if tab._tz is not None:
+            # build the offset table here so every forked tab process inherits it
+            get_offset_table(tab._tz)
+        if tab._every_kwargs is None and tab._trigger_spec is None and tab._after_names:
+            # tabs that only run after other tabs don't need a resident process
+            tab._prepare_triggered()
+            return
+        target = tab._get_target()
+        self.monitor.add_subprocess(tab._name, target, tab._robust, tab._from_wall(tab._until))
+        if tab._on_demand:
+            self.monitor.spawn_on_demand(tab._name, tab._on_demand_schedule)
+        self.monitor.watch_memory(tab._name, tab._max_rss_mb, tab._recycle_event)
+
+    def _register_many(self, template, params_iterable):
+        # validates the template and fixes the until time of .lasting() for all its tabs
+        template._get_target()
+        frozen = copy.copy(template)
+        frozen._lasting_delta = None
+        frozen._send_result = ctypes.c_bool(any(t._pass_result for t in self._tab_list))
+        # forked processes share the template as it is, so only pickle it for other start methods
+        blob = frozen if _forks_processes() else pickle.dumps(frozen)
+
+        admission_event = None
+        for params in params_iterable:
+            name = template._name.format(**params)
+            if self._admission is not None:
+                admission_event = self._admission.grant_event(name)
+            runtime = (self.monitor.q_event, admission_event, self._priorities.get(name, 0))
+            spec = TabSpec(blob, name, params, runtime)
+            self.monitor.add_subprocess(name, spec, template._robust, template._from_wall(template._until))
+            if template._allow_children:
+                self.monitor.allow_children(name)
+
     def go(self, max_seconds=None):
         for tab in self._tab_list:
-            target = tab._get_target()
-            self.monitor.add_subprocess(tab._name, target, tab._robust, tab._until)
+            self._register(tab)
+        for template, params_iterable in self._bulk_list:
+            self._register_many(template, params_iterable)
         try:
             self.monitor.loop(max_seconds=max_seconds)
         except KeyboardInterrupt:  # pragma: no cover
             pass
 
 
+class TabSpec(object):
+    __slots__ = ('blob', 'name', 'params', 'runtime')
+
+    def __init__(self, blob, name, params, runtime):
+        """
+        A compact stand-in for a tab created by Cron.schedule_many().  It is the target of
+        the tab process, where it builds the actual tab from the pickled template.
+        :param blob: The template tab, or the template pickled where processes are not forked.
+                     It is shared by all specs of the template.
+        :param name: The name of the tab
+        :param params: A dict merged into the keyword arguments of the template function
+        :param runtime: The (event_queue, admission_event, priority) filled in by the cron
+        """
+        self.blob = blob
+        self.name = name
+        self.params = params
+        self.runtime = runtime
+
+    def build(self):
+        tab = pickle.loads(self.blob) if isinstance(self.blob, bytes) else copy.copy(self.blob)
+        tab._name = self.name
+        tab._func_kwargs = dict(tab._func_kwargs, **self.params)
+        tab._event_queue, tab._admission_event, tab._priority = self.runtime
+        return tab
+
+    def __call__(self):  # pragma: no cover  runs in the tab process
+        return self.build()._get_target()()
+
+
+def _forks_processes():
+    # the default start method is listed first
+    method = multiprocessing.get_start_method(allow_none=True) or multiprocessing.get_all_start_methods()[0]
+    return method == 'fork'
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_date(text, default):
+    # Tabs built from templates and reloaded configs parse the same strings over and over.
+    # Strings like "09:00" take their date from default, so it is part of the cache key.
+    return parse(text, default=default)
+
+
+def _stable_key(obj):
+    """
+    Returns a comparable representation of obj that survives re-creating it,
+    for example when a config file defining functions is executed again.
+    """
+    try:
+        return pickle.dumps(obj)
+    except Exception:
+        code = getattr(obj, '__code__', None)
+        if code is not None:
+            return (obj.__module__, obj.__qualname__, code.co_code, repr(code.co_consts))
+        return repr(obj)
+
+
 class Tab:
     _SILENCE_LOGGER = False
 
-    def __init__(self, name, robust=True, verbose=True, memory_friendly=False):
+    _PROFILE_MODES = {'cprofile', 'tracemalloc'}
+    # Interval units that tabs with a timezone step in UTC rather than in wall time
+    _UTC_STEP_UNITS = {'second', 'minute', 'hour'}
+
+    # Primitives shared with the tab process, settings filled in by the cron and state
+    # built inside the tab process.  They don't define the tab.
+    _RUNTIME_ATTRS = (
+        '_profile_runs', '_recycle_event', '_event_queue', '_admission_event', '_one_shot_admission_event',
+        '_one_shot', '_priority',
+        '_resource', '_resource_built', '_send_result',
+    )
+
+    # Results larger than this are not passed to downstream tabs
+    MAX_RESULT_BYTES = 64 * 1024
+
+    # How often a tab waiting on a trigger wakes up to check whether it should stop
+    TRIGGER_WAKE_SECONDS = 1
+
+    def __init__(
+            self, name, robust=True, verbose=True, memory_friendly=False, profile=None, profile_dir='.',
+            max_rss_mb=None, max_runs=None, spread=None, retries=0, retry_backoff=1, retry_on=(Exception,),
+            on_demand=False, lead_seconds=5, tz=None,
+    ):
         """
         Schedules a Tab entry in the cron runner
         :param name:  Every tab must have a string name
@@ -56,10 +439,82 @@ class Tab:
                         non-errored tabs should continue running
         :param verbose: Set the verbosity of log messages.
         :memory friendly: If set to true, each iteration will be run in separate process
+        :param profile: One of "cprofile" or "tracemalloc" (or a list of both).  Enables
+                        profiling of runs requested with Cron.profile() or by sending
+                        Cron.PROFILE_SIGNAL to the parent process.
+        :param profile_dir: The directory profile results are written to
+        :param max_rss_mb: Recycle the tab process between runs once its resident memory
+                           exceeds this many megabytes
+        :param max_runs: Recycle the tab process after it has completed this many runs
+        :param spread: Offset the interval boundaries of this tab by up to this many seconds.
+                       The offset is derived from the name, so it is the same on every start
+                       and tabs sharing an interval don't all fire at the same moment.
+        :param retries: Retry a failed run up to this many times within the same interval
+        :param retry_backoff: Seconds to wait before the first retry.  The wait doubles with
+                              every retry, and retries that would run into the next
+                              scheduled run are skipped.
+        :param retry_on: The exception types that are retried
+        :param on_demand: If set to true, no process is kept between runs.  The cron starts a
+                          process lead_seconds before each run and the process exits after it.
+        :param lead_seconds: How long before each run an on demand process is started, giving
+                             it time to import modules and warm up
+        :param tz: A timezone name like "America/New_York" or a tzinfo object.  Interval
+                   boundaries, .starting()/.until() times and the times passed to .excluding()
+                   and .during() functions are then wall times in this timezone rather than
+                   in the local timezone of the machine.
         """
         if not isinstance(name, str):
             raise ValueError('Name argument must be a string')
 
+        if isinstance(profile, str):
+            profile = [profile]
+        self._profile_modes = frozenset(profile or [])
+        if not self._profile_modes <= self._PROFILE_MODES:
+            raise ValueError('Allowed profile values are {}'.format(sorted(self._PROFILE_MODES)))
+        self._profile_dir = profile_dir
+        # A counter shared with the tab process holding the number of runs left to profile
+        self._profile_runs = multiprocessing.Value('i', 0) if self._profile_modes else None
+
+        self._max_rss_mb = max_rss_mb
+        self._max_runs = max_runs
+        # Set by the process monitor when the tab process should be recycled
+        self._recycle_event = multiprocessing.Event() if max_rss_mb is not None else None
+
+        self._after_names = set()
+        self._pass_result = False
+        # Filled in by the cron so the tab process can report completed runs
+        self._event_queue = None
+        # A flag shared with the cron, which sets it when a downstream tab uses the results of this one
+        self._send_result = None
+
+        # A (trigger_class, args) tuple for tabs that run on events instead of intervals
+        self._trigger_spec = None
+        self._debounce_seconds = 0
+        self._pass_events = False
+
+        if spread and not spread >= .001:
+            # offsets are whole milliseconds
+            raise ValueError('spread must be at least .001 seconds')
+        self._spread = spread
+        # Filled in by a cron with max_concurrent_runs so runs wait for admission.  Processes
+        # running the tab once after an upstream tab wait on an event of their own.
+        self._admission_event = None
+        self._one_shot_admission_event = None
+        self._one_shot = False
+        self._priority = 0
+
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        self._retry_on = tuple(retry_on) if isinstance(retry_on, (list, tuple)) else (retry_on,)
+
+        self._setup_func = None
+        self._teardown_func = None
+        # Set by .map() when the tab process starts a pool of worker processes
+        self._allow_children = False
+        # The value returned by the setup function, built once per tab process
+        self._resource = None
+        self._resource_built = False
+
         self._name = name
         self._robust = robust
         self._verbose = verbose
@@ -71,9 +526,28 @@ class Tab:
         self._exclude_func = self._default_exclude_func
         self._during_func = self._default_during_func
         self._memory_friendly = memory_friendly
+        self._on_demand = on_demand
+        self._lead_seconds = lead_seconds
+        self._tz = get_timezone(tz) if tz is not None else None
         self._until = None
         self._lasting_delta = None
 
+    def _fingerprint(self):
+        """
+        Returns a value that compares equal for tabs with identical definitions.
+        """
+        attrs = dict(vars(self))
+        if attrs['_exclude_func'] == self._default_exclude_func:
+            attrs['_exclude_func'] = None
+        if attrs['_during_func'] == self._default_during_func:
+            attrs['_during_func'] = None
+        if self._lasting_delta is not None:
+            # .lasting() fills in the until time when the tab is started
+            attrs.pop('_until')
+        for key in self._RUNTIME_ATTRS:
+            attrs.pop(key)
+        return tuple((key, _stable_key(attrs[key])) for key in sorted(attrs))
+
     def _default_exclude_func(self, t):
         return False
 
@@ -87,11 +561,55 @@ class Tab:
 
     def _process_date(self, datetime_or_str):
         if isinstance(datetime_or_str, str):
-            return parse(datetime_or_str)
+            today = self._now().replace(hour=0, minute=0, second=0, microsecond=0)
+            date = _parse_date(datetime_or_str, today)
         elif isinstance(datetime_or_str, datetime.datetime):
-            return datetime_or_str
+            date = datetime_or_str
         else:
             raise ValueError('.starting() and until() method can only take strings or datetime objects')
+        if date.tzinfo is not None:
+            # tabs work in naive wall times of their own timezone
+            date = date.astimezone(self._tz).replace(tzinfo=None)
+        return date
+
+    def _get_offset_table(self):
+        return get_offset_table(self._tz)
+
+    def _now(self):
+        """
+        Returns the current wall time of the tab
+        """
+        if self._tz is None:
+            return datetime.datetime.now()
+        return from_seconds(self._get_offset_table().to_local(time.time()))
+
+    def _seconds_until(self, wall_time):
+        """
+        Returns the seconds from now until a wall time of the tab, or until an aware time
+        """
+        if wall_time.tzinfo is not None:
+            return wall_time.timestamp() - time.time()
+        if self._tz is None:
+            return (wall_time - datetime.datetime.now()).total_seconds()
+        return self._get_offset_table().to_utc(to_seconds(wall_time)) - time.time()
+
+    def _to_wall(self, local_time):
+        """
+        Converts a naive time in the local timezone of the machine to a wall time of the tab
+        """
+        if self._tz is None:
+            return local_time
+        return from_seconds(self._get_offset_table().to_local(local_time.timestamp()))
+
+    def _from_wall(self, wall_time):
+        """
+        Converts a wall time of the tab to a naive time in the local timezone of the machine
+        """
+        if self._tz is None or wall_time is None:
+            return wall_time
+        if wall_time.tzinfo is not None:
+            return wall_time.astimezone().replace(tzinfo=None)
+        return datetime.datetime.fromtimestamp(self._get_offset_table().to_utc(to_seconds(wall_time)))
 
     def starting(self, datetime_or_str):
         """
@@ -125,6 +643,10 @@ class Tab:
         as that of the .every() method
         """
         relative_delta_kwargs = {k if k.endswith('s') else k + 's': v for (k, v) in kwargs.items()}
+        if 'milliseconds' in relative_delta_kwargs:
+            # relativedelta has no milliseconds
+            milliseconds = relative_delta_kwargs.pop('milliseconds')
+            relative_delta_kwargs['microseconds'] = int(round(milliseconds * 1000))
         self._lasting_delta = relativedelta(**relative_delta_kwargs)
         return self
 
@@ -152,11 +674,98 @@ class Tab:
 
         return self
 
+    def after(self, upstream_name, pass_result=False):
+        """
+        Run this tab as soon as the tab named upstream_name completes a successful run.
+        It can be combined with .every(), or used on its own in which case the tab has
+        no process of its own between runs.  Call it more than once to run after any
+        of several upstream tabs.
+
+        :param upstream_name: The name of the upstream tab
+        :param pass_result: If True, the value returned by the upstream function is passed
+                            as the first positional argument.  Results that can't be pickled
+                            or are larger than Tab.MAX_RESULT_BYTES are passed as None.  Tabs
+                            that also run on .every() or a trigger can't use this.
+        :return: self
+        """
+        if upstream_name == self._name:
+            raise ValueError('A tab can not run after itself')
+        self._after_names.add(upstream_name)
+        self._pass_result = pass_result
+        return self
+
+    def on_file_change(self, path, debounce_seconds=.1, pass_events=False, poll_seconds=1):
+        """
+        Run the tab whenever the file at path is modified, created, replaced or deleted.
+        Uses inotify where available and otherwise polls the file metadata.
+
+        :param path: The path of the file to watch
+        :param debounce_seconds: Changes arriving within this many seconds of each other are
+                                 coalesced into a single run
+        :param pass_events: If True, the list of changed paths is passed as the first
+                            positional argument
+        :param poll_seconds: How often to check the file when inotify is not available
+        :return: self
+        """
+        return self._set_trigger(FileTrigger, (path, poll_seconds), debounce_seconds, pass_events)
+
+    def on_directory(self, path, debounce_seconds=.1, pass_events=False, poll_seconds=1):
+        """
+        Run the tab whenever files directly inside the directory at path are created,
+        modified or removed.  The arguments are the same as those of .on_file_change()
+        """
+        return self._set_trigger(DirectoryTrigger, (path, poll_seconds), debounce_seconds, pass_events)
+
+    def on_queue(self, q, debounce_seconds=0, pass_events=True):
+        """
+        Run the tab whenever messages are put on a multiprocessing queue.
+
+        :param q: A multiprocessing.Queue
+        :param debounce_seconds: Messages arriving within this many seconds of each other are
+                                 handled in a single run
+        :param pass_events: If True, the list of messages is passed as the first positional argument
+        :return: self
+        """
+        return self._set_trigger(QueueTrigger, (q,), debounce_seconds, pass_events)
+
+    def _set_trigger(self, trigger_class, args, debounce_seconds, pass_events):
+        if self._trigger_spec is not None:
+            raise ValueError('A tab can only have one trigger')
+        self._trigger_spec = (trigger_class, args)
+        self._debounce_seconds = debounce_seconds
+        self._pass_events = pass_events
+        return self
+
+    def setup(self, factory):
+        """
+        Specify a function that builds expensive state, like a connection pool, once per
+        tab process.  Its return value is passed as the first positional argument of every
+        run, ahead of any trigger events or upstream results.  It is only built again when
+        the process is replaced, for example by memory_friendly or max_runs.
+
+        :param factory: A callable taking no arguments
+        :return: self
+        """
+        self._setup_func = factory
+        return self
+
+    def teardown(self, func):
+        """
+        Specify a function that is passed the value built by .setup() when the tab
+        process finishes gracefully, for example when it is recycled or expires.
+
+        :param func: A callable taking the value built by the setup function
+        :return: self
+        """
+        self._teardown_func = func
+        return self
+
     def every(self, **kwargs):
         """
         Specify the interval at which you want the job run.  Takes exactly one keyword argument.
-        That argument must be one named one of [second, minute, hour, day, week, month, year] or
-        their plural equivalents.
+        That argument must be one named one of [millisecond, second, minute, hour, day, week, month,
+        year] or their plural equivalents.  Millisecond intervals run on a lightweight loop that
+        doesn't log every run.
 
         :param kwargs: Exactly one keyword argument
         :return: self
@@ -182,8 +791,31 @@ class Tab:
         self._func_kwargs = func__kwargs
         return self
 
+    def map(self, func, partitions, workers=4, timeout=None, executor='thread'):
+        """
+        Specify a function to run once for every partition at the scheduled times.
+        Partitions are processed in parallel by a pool of workers, and the run completes
+        when all partitions have finished or the timeout has passed.  Use this instead
+        of .run().  When the tab retries a run, only the partitions that failed run again.
+
+        :param func:  a callable taking a partition as its last positional argument.  Any
+                      value built by .setup(), trigger events or upstream results come first.
+        :param partitions: an iterable of hashable partitions, or a callable returning one
+                           that is evaluated on every run
+        :param workers: the number of workers in the pool
+        :param timeout: seconds to wait for all partitions before giving up on the rest.  Requires
+                        the "process" executor, whose busy workers are terminated at the timeout.
+        :param executor: "thread" or "process"
+        :return: self
+        """
+        self.run(PartitionMap(func, partitions, workers, timeout, executor, name=self._name))
+        self._allow_children = executor == 'process'
+        return self
+
     def _clean_kwargs(self, kwargs):
         allowed_key_map = {
+            'milliseconds': 'millisecond',
+            'millisecond': 'millisecond',
             'seconds': 'second',
             'second': 'second',
             'minutes': 'minute',
@@ -229,12 +861,302 @@ class Tab:
 
         return can_run
 
-    def _loop(self, max_iter=None):
+    def profile_next(self, runs=1):
+        """
+        Profile the next runs of this tab.  The tab must have been created with a profile argument.
+        """
+        if self._profile_runs is None:
+            raise ValueError('Tab {} was not created with a profile argument'.format(self._name))
+        with self._profile_runs.get_lock():
+            self._profile_runs.value += runs
+        return self
+
+    def _claim_profile_run(self):
+        with self._profile_runs.get_lock():
+            if self._profile_runs.value > 0:
+                self._profile_runs.value -= 1
+                return True
+        return False
+
+    def _spread_offset(self):
+        if not self._spread:
+            return datetime.timedelta(0)
+        milliseconds = zlib.crc32(self._name.encode('utf-8')) % int(self._spread * 1000)
+        return datetime.timedelta(milliseconds=milliseconds)
+
+    def _execute(self, extra_args=(), deadline=None):
+        """
+        Run the function, retrying failures if the tab allows it.
+
+        :param extra_args: Arguments passed ahead of the ones given to .run()
+        :param deadline: A time.time() value that retries must not run past
+        """
+        if not self._retries:
+            return self._admitted_call(extra_args)
+
+        attempt = 0
+        while True:
+            try:
+                return self._admitted_call(extra_args)
+            except Exception as error:
+                if not self._is_retryable(error) or attempt >= self._retries:
+                    raise
+                delay = self._retry_backoff * 2 ** attempt
+                if deadline is not None and time.time() + delay >= deadline:
+                    self._log('Not retrying {} because the next run is due'.format(self._name))
+                    raise
+                if isinstance(error, PartitionError) and isinstance(self._func, PartitionMap):
+                    # partitions that succeeded must not run twice
+                    self._func.resume(error, self._retry_on)
+                attempt += 1
+                logger = daiquiri.getLogger(self._name)
+                logger.warning('Retry {} of {} in {:g} seconds after {!r}'.format(
+                    attempt, self._retries, delay, error))
+                self._notify('retry', attempt)
+                time.sleep(delay)
+
+    def _is_retryable(self, error):
+        if isinstance(error, PartitionError) and isinstance(self._func, PartitionMap):
+            return any(isinstance(e, self._retry_on) for e in error.errors.values())
+        return isinstance(error, self._retry_on)
+
+    def _admitted_call(self, extra_args):
+        if self._admission_event is None:
+            return self._call(extra_args)
+
+        self._event_queue.put(('acquire', self._name, (self._priority, os.getpid(), self._one_shot)))
+        self._admission_event.wait()
+        self._admission_event.clear()
+        try:
+            return self._call(extra_args)
+        finally:
+            self._event_queue.put(('release', self._name, os.getpid()))
+
+    def _call(self, extra_args):
+        args = extra_args + self._func_args
+        if self._setup_func is not None:
+            if not self._resource_built:
+                self._log('Running setup for {}'.format(self._name))
+                self._resource = self._setup_func()
+                self._resource_built = True
+            args = (self._resource,) + args
+        if self._profile_runs is not None and self._claim_profile_run():
+            return self._profiled_execute(args)
+        return self._func(*args, **self._func_kwargs)
+
+    def _notify(self, kind, payload=None):
+        if self._event_queue is not None:
+            self._event_queue.put((kind, self._name, payload))
+
+    def _log_error(self):
+        s = 'Error in tab\n' + traceback.format_exc()
+        logger = daiquiri.getLogger(self._name)
+        logger.error(s)
+        self._notify('failure')
+
+    def _notify_success(self, result):
+        if self._event_queue is None:
+            return
+        if self._send_result is None or not self._send_result.value:
+            # nothing downstream uses the result, so don't pay for pickling it
+            result = None
+        if result is not None:
+            try:
+                too_big = len(pickle.dumps(result)) > self.MAX_RESULT_BYTES
+            except Exception:
+                too_big = True
+            if too_big:
+                self._log('Result is too large or can\'t be pickled. Passing None downstream.')
+                result = None
+        self._notify('success', result)
+
+    def _profiled_execute(self, args):
+        base_name = '{}.{}'.format(
+            re.sub(r'[^\w.-]', '_', self._name), datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+        base_path = os.path.join(self._profile_dir, base_name)
+
+        profiler = cProfile.Profile() if 'cprofile' in self._profile_modes else None
+        trace_memory = 'tracemalloc' in self._profile_modes
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            if profiler is not None:
+                return profiler.runcall(self._func, *args, **self._func_kwargs)
+            return self._func(*args, **self._func_kwargs)
+        finally:
+            if profiler is not None:
+                profiler.dump_stats(base_path + '.prof')
+                self._log('Wrote {}.prof'.format(base_path))
+            if trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                snapshot.dump(base_path + '.tracemalloc')
+                with open(base_path + '.tracemalloc.txt', 'w') as buff:
+                    for stat in snapshot.statistics('lineno')[:50]:
+                        buff.write('{}\n'.format(stat))
+                self._log('Wrote {}.tracemalloc'.format(base_path))
+
+    def _sleep(self, seconds, n_runs):
+        """
+        Sleep for the given number of seconds.  Returns False if woken early because
+        the monitor asked for the process to be recycled.
+        """
+        if self._recycle_event is not None and n_runs > 0:
+            return not self._recycle_event.wait(seconds)
+        time.sleep(seconds)
+        return True
+
+    def _should_recycle(self, n_runs):
+        """
+        A process is only recycled between runs and after it has run at least once.
+        """
+        if n_runs == 0:
+            return False
+        if self._max_runs is not None and n_runs >= self._max_runs:
+            self._log('Recycling {} after {} runs'.format(self._name, n_runs))
+            return True
+        if self._recycle_event is not None and self._recycle_event.is_set():
+            self._log('Recycling {} to release memory'.format(self._name))
+            return True
+        return False
+
+    def _steps_in_utc(self):
+        """
+        Tabs with a timezone step intervals shorter than a day in UTC, so they keep running
+        every interval while the clocks change.  Longer intervals follow the wall clock.
+        """
+        return self._tz is not None and set(self._every_kwargs) <= self._UTC_STEP_UNITS
+
+    def _previous_boundary(self, now):
+        """
+        Returns the latest interval boundary at or before now, which is a wall time of the
+        tab or an aware time.  Boundaries of tabs stepping in UTC are aware UTC times.
+        """
+        offset = self._spread_offset()
+        if not self._steps_in_utc():
+            return fleming.floor(now - offset, **self._every_kwargs) + offset
+        table = self._get_offset_table()
+        utc_seconds = now.timestamp() if now.tzinfo is not None else table.to_utc(to_seconds(now))
+        # floor the wall time in the offset in effect at now, so a wall time repeated when
+        # the clocks go back resolves to the occurrence we are in
+        utc_offset = table.offset(utc_seconds)
+        boundary = fleming.floor(from_seconds(utc_seconds + utc_offset) - offset, **self._every_kwargs) + offset
+        return datetime.datetime.fromtimestamp(to_seconds(boundary) - utc_offset, datetime.timezone.utc)
+
+    def _next_fire_time(self, now):
+        """
+        Returns the first interval boundary after now
+        """
+        relative_delta_kwargs = {k + 's': v for (k, v) in self._every_kwargs.items()}
+        return self._previous_boundary(now) + relativedelta(**relative_delta_kwargs)
+
+    def _spawn_time(self, now):
+        """
+        Returns when the process of an on demand tab should be started so that it is
+        ready for the first run after now.  A process started any earlier than the
+        previous boundary would wait for the wrong run, so never return a time before now.
+        """
+        fire_time = self._from_wall(self._next_fire_time(self._boundary_time(now)))
+        return max(fire_time - datetime.timedelta(seconds=self._lead_seconds), now)
+
+    def _on_demand_schedule(self, now):
+        """
+        Returns when to start the process of an on demand tab, and the keyword arguments
+        telling the process which run it was started for.
+        """
+        return self._spawn_time(now), {'fire_time': self._next_fire_time(self._boundary_time(now))}
+
+    def _boundary_time(self, local_time):
+        """
+        Converts a naive time in the local timezone of the machine to the time boundaries
+        are computed from
+        """
+        if self._steps_in_utc():
+            return local_time.astimezone()
+        return self._to_wall(local_time)
+
+    def _fast_loop_clock(self):
+        """
+        Returns the period, the first tick and the until time of a millisecond tab as
+        integer nanoseconds on the monotonic clock.
+        """
+        period_ns = int(self._every_kwargs['millisecond'] * 1000000)
+        if period_ns <= 0:
+            raise ValueError('Millisecond intervals must be positive')
+        offset_ns = int(self._spread_offset().total_seconds() * 1e9)
+
+        wall_ns, monotonic_ns = time.time_ns(), time.monotonic_ns()
+        next_wall_ns = ((wall_ns - offset_ns) // period_ns + 1) * period_ns + offset_ns
+        next_ns = monotonic_ns + next_wall_ns - wall_ns
+        until_ns = None
+        if self._until is not None:
+            until_ns = monotonic_ns + int(self._seconds_until(self._until) * 1e9)
+        return period_ns, next_ns, until_ns
+
+    def _fast_loop(self, max_iter=None):
+        """
+        A loop for sub-second intervals.  Tick times are integer nanoseconds on the monotonic
+        clock, aligned once to the wall clock, so each tick avoids datetime arithmetic.
+        """
+        if not self._SILENCE_LOGGER:  # pragma: no cover don't want to clutter tests
+            logger = daiquiri.getLogger(self._name)
+            logger.info('Starting {}'.format(self._name))
+        period_ns, next_ns, until_ns = self._fast_loop_clock()
+
+        # Only pay for building timestamps when the tab actually has inhibitions
+        inhibited = (
+            self._exclude_func != self._default_exclude_func or self._during_func != self._default_during_func
+        )
+
+        n_iter = 0
+        n_runs = 0
+        while True:
+            n_iter += 1
+            if (max_iter is not None and n_iter > max_iter) or self._should_recycle(n_runs):
+                break
+
+            now_ns = time.monotonic_ns()
+            if next_ns < now_ns:
+                # skip the ticks missed while the function was running
+                next_ns += ((now_ns - next_ns) // period_ns + 1) * period_ns
+            if not self._sleep((next_ns - now_ns) / 1e9, n_runs):
+                continue
+            next_ns += period_ns
+
+            if until_ns is not None and time.monotonic_ns() > until_ns:
+                break
+            if inhibited and not self._is_uninhibited(self._now()):
+                continue
+
+            n_runs += 1
+            try:
+                deadline = time.time() + (next_ns - time.monotonic_ns()) / 1e9
+                self._notify_success(self._execute(deadline=deadline))
+            except KeyboardInterrupt:  # pragma: no cover
+                pass
+            except:  # noqa
+                if not self._robust:
+                    raise
+                self._log_error()
+        self._log('Finishing {}'.format(self._name))
+
+    def _first_boundary(self, fire_time, interval):
+        """
+        Returns the interval boundary the loop starts from.  On demand processes are told
+        the run they were started for, so they start one interval before it.
+        """
+        if fire_time is not None:
+            return fire_time - interval
+        if self._steps_in_utc():
+            return self._previous_boundary(datetime.datetime.fromtimestamp(time.time(), datetime.timezone.utc))
+        return self._previous_boundary(self._now())
+
+    def _loop(self, max_iter=None, fire_time=None):
         if not self._SILENCE_LOGGER:  # pragma: no cover don't want to clutter tests
             logger = daiquiri.getLogger(self._name)
             logger.info('Starting {}'.format(self._name))
+
         # fleming and dateutil have arguments that just differ by ending in an "s"
-        fleming_kwargs = self._every_kwargs
         relative_delta_kwargs = {}
 
         # build the relative delta kwargs
@@ -242,15 +1164,16 @@ class Tab:
             relative_delta_kwargs[k + 's'] = v
 
         # Previous time is the latest interval boundary that has already happened
-        previous_time = fleming.floor(datetime.datetime.now(), **fleming_kwargs)
+        previous_time = self._first_boundary(fire_time, relativedelta(**relative_delta_kwargs))
 
-        # keep track of iterations
+        # keep track of iterations and of how many times the function actually ran
         n_iter = 0
+        n_runs = 0
         # this is the infinite loop that runs the cron.  It will only be stopped when the
         # process is killed by its monitor.
         while True:
             n_iter += 1
-            if max_iter is not None and n_iter > max_iter:
+            if (max_iter is not None and n_iter > max_iter) or self._should_recycle(n_runs):
                 break
             # everything is run in a try block so errors can be explicitly handled
             try:
@@ -258,19 +1181,18 @@ class Tab:
                 next_time = previous_time + relativedelta(**relative_delta_kwargs)
                 previous_time = next_time
 
-                # get the current time
-                now = datetime.datetime.now()
-
-                # if our job ran longer than an interval, we will need to catch up
-                if next_time < now:
+                # if our job ran longer than an interval, we will need to catch up.  An on
+                # demand process that took longer to start than expected still runs.
+                sleep_seconds = self._seconds_until(next_time)
+                if sleep_seconds < 0 and fire_time is None:
                     continue
 
                 # sleep until the computed time to run the function
-                sleep_seconds = (next_time - now).total_seconds()
-                time.sleep(sleep_seconds)
+                if not self._sleep(max(sleep_seconds, 0), n_runs):
+                    continue
 
                 # See what time it is on wakeup
-                timestamp = datetime.datetime.now()
+                timestamp = self._now()
 
                 # If passed until date, break out of here
                 if self._until is not None and timestamp > self._until:
@@ -279,7 +1201,10 @@ class Tab:
                 # If not inhibited, run the function
                 if self._is_uninhibited(timestamp):
                     self._log('Running {}'.format(self._name))
-                    self._func(*self._func_args, **self._func_kwargs)
+                    n_runs += 1
+                    # retries must finish before the next interval boundary
+                    deadline = time.time() + self._seconds_until(next_time + relativedelta(**relative_delta_kwargs))
+                    self._notify_success(self._execute(deadline=deadline))
 
             except KeyboardInterrupt:  # pragma: no cover
                 pass
@@ -287,27 +1212,123 @@ class Tab:
             except:  # noqa
                 # only raise the error if not in robust mode.
                 if self._robust:
-                    s = 'Error in tab\n' + traceback.format_exc()
-                    logger = daiquiri.getLogger(self._name)
-                    logger.error(s)
+                    self._log_error()
                 else:
                     raise
         self._log('Finishing {}'.format(self._name))
 
+    def _run_once(self, *extra_args):
+        """
+        Run the function a single time for a tab that was triggered by an upstream tab
+        or an event.  Returns True if the function was run.
+        """
+        timestamp = self._now()
+        if self._until is not None and timestamp > self._until:
+            return False
+        if not self._is_uninhibited(timestamp):
+            return False
+        try:
+            self._log('Running {}'.format(self._name))
+            self._notify_success(self._execute(extra_args))
+        except:  # noqa
+            if self._robust:
+                self._log_error()
+            else:
+                raise
+        return True
+
+    def _trigger_loop(self, max_runs=None):
+        if not self._SILENCE_LOGGER:  # pragma: no cover don't want to clutter tests
+            logger = daiquiri.getLogger(self._name)
+            logger.info('Starting {}'.format(self._name))
+        trigger_class, trigger_args = self._trigger_spec
+        trigger = trigger_class(*trigger_args)
+        n_runs = 0
+        try:
+            while not ((max_runs is not None and n_runs >= max_runs) or self._should_recycle(n_runs)):
+                if self._until is not None and self._now() > self._until:
+                    break
+                events = trigger.wait(self.TRIGGER_WAKE_SECONDS)
+                if not events:
+                    continue
+                events = coalesce(trigger, events, self._debounce_seconds, 10 * self._debounce_seconds)
+                if self._run_once(*((events,) if self._pass_events else ())):
+                    n_runs += 1
+        finally:
+            trigger.close()
+        self._log('Finishing {}'.format(self._name))
+
+    def _prepare_triggered(self):
+        if self._func is None:
+            raise ValueError('You must call the .run() method on every tab.')
+        if self._lasting_delta is not None:
+            self._until = self._now() + self._lasting_delta
+
+    def _with_resources(self, target, *args, **kwargs):
+        """
+        Runs target, tearing down whatever the setup function built once it finishes
+        """
+        try:
+            return target(*args, **kwargs)
+        finally:
+            if self._resource_built:
+                resource, self._resource, self._resource_built = self._resource, None, False
+                if self._teardown_func is not None:
+                    self._log('Running teardown for {}'.format(self._name))
+                    self._teardown_func(resource)
+
+    def _get_trigger_target(self, result):
+        """
+        returns a callable with no arguments that runs the tab once in response
+        to an upstream tab completing
+        """
+        target = functools.partial(self._run_once, result) if self._pass_result else self._run_once
+        if self._setup_func is not None:
+            target = functools.partial(self._with_resources, target)
+        return functools.partial(self._run_one_shot, target)
+
+    def _run_one_shot(self, target):
+        # the resident process of the tab may be waiting for admission at the same time
+        self._admission_event, self._one_shot = self._one_shot_admission_event, True
+        return target()
+
     def _get_target(self):
         """
         returns a callable with no arguments designed
         to be the target of a Subprocess
         """
-        if None in [self._func, self._func_kwargs, self._func_kwargs, self._every_kwargs]:
+        if self._every_kwargs is not None and self._trigger_spec is not None:
+            raise ValueError('A tab can not be scheduled with both .every() and a trigger.')
+        if self._pass_result:
+            # scheduled runs have no upstream result to pass
+            raise ValueError('Tabs using .after(..., pass_result=True) can not use .every() or a trigger.')
+        schedule = self._every_kwargs if self._trigger_spec is None else self._trigger_spec
+        if None in [self._func, self._func_kwargs, self._func_kwargs, schedule]:
             raise ValueError('You must call the .every() and .run() methods on every tab.')
 
-        if self._memory_friendly:  # pragma: no cover  TODO: need to find a way to test this
-            target = functools.partial(self._loop, max_iter=1)
+        if self._on_demand and (self._trigger_spec is not None or 'millisecond' in self._every_kwargs):
+            raise ValueError('On demand tabs must use .every() with intervals of a second or more.')
+
+        if self._memory_friendly and self._trigger_spec is not None:
+            # a fresh process per run would miss the events arriving while no process is watching
+            raise ValueError('Tabs with triggers can not be memory_friendly.  Use max_runs or max_rss_mb instead.')
+
+        if self._trigger_spec is not None:
+            loop, limit_kwargs = self._trigger_loop, {'max_runs': 1}
+        elif 'millisecond' in self._every_kwargs:
+            loop, limit_kwargs = self._fast_loop, {'max_iter': 1}
+        else:
+            loop, limit_kwargs = self._loop, {'max_iter': 1}
+
+        if self._memory_friendly or self._on_demand:  # pragma: no cover  TODO: need to find a way to test this
+            target = functools.partial(loop, **limit_kwargs)
         else:  # pragma: no cover  TODO: need to find a way to test this
-            target = self._loop
+            target = loop
+
+        if self._setup_func is not None:
+            target = functools.partial(self._with_resources, target)
 
         if self._lasting_delta is not None:
-            self._until = datetime.datetime.now() + self._lasting_delta
+            self._until = self._now() + self._lasting_delta
 
         return target
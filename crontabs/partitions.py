@@ -0,0 +1,120 @@
+"""
+Fan out the work of a single tab run over partitions in a pool of workers
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+import concurrent.futures
+
+import daiquiri
+
+
+class PartitionError(Exception):
+    def __init__(self, results, errors):
+        """
+        Raised when some partitions of a run failed or did not finish in time.
+        :param results: A dict mapping partitions that succeeded to their results
+        :param errors: A dict mapping partitions that failed to their exceptions
+        """
+        super(PartitionError, self).__init__('{} of {} partitions failed: {!r}'.format(
+            len(errors), len(errors) + len(results), sorted(errors, key=repr)))
+        self.results = results
+        self.errors = errors
+
+
+class PartitionMap(object):
+    EXECUTORS = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor,
+    }
+
+    def __init__(self, func, partitions, workers=4, timeout=None, executor='thread', name='crontabs'):
+        """
+        A callable that runs func once for each partition in a pool of workers.
+        :param func: A callable taking a partition as its last positional argument
+        :param partitions: An iterable of hashable partitions, or a callable returning one.
+                           A callable is evaluated on every run.
+        :param workers: The number of workers in the pool
+        :param timeout: Seconds to wait for all partitions before giving up on the rest.
+                        Workers still busy then are terminated, which is only possible for
+                        processes, so a timeout requires the "process" executor.
+        :param executor: Either "thread" or "process"
+        :param name: The name used for log messages
+        """
+        if executor not in self.EXECUTORS:
+            raise ValueError('Allowed executors are {}'.format(sorted(self.EXECUTORS)))
+        if workers < 1:
+            raise ValueError('There must be at least one worker')
+        if timeout is not None and executor != 'process':
+            # a hung thread can't be stopped and would keep the tab process from exiting
+            raise ValueError('A timeout requires executor="process"')
+        self.func = func
+        self.partitions = partitions
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = executor
+        self.name = name
+        # A (results, errors, partitions) tuple set by .resume()
+        self._resume = None
+
+    def resume(self, error, retry_on=(Exception,)):
+        """
+        Make the next call only run the partitions of a PartitionError that failed with one of
+        the retry_on exception types.  The results and other errors of error are kept.
+        """
+        partitions = [p for (p, e) in error.errors.items() if isinstance(e, retry_on)]
+        errors = {p: e for (p, e) in error.errors.items() if p not in partitions}
+        self._resume = (dict(error.results), errors, partitions)
+
+    @staticmethod
+    def _terminate_workers(pool):
+        """
+        Stops the processes of a ProcessPoolExecutor that are stuck in partitions that timed out
+        """
+        terminate_workers = getattr(pool, 'terminate_workers', None)
+        if terminate_workers is not None:  # pragma: no cover  python 3.14+
+            terminate_workers()
+            return
+        # Before python 3.14 the executor has no public way to do this, so fall back to the
+        # _processes dict CPython keeps of its workers
+        for process in list((getattr(pool, '_processes', None) or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False)
+
+    def __call__(self, *args, **kwargs):
+        """
+        Runs all partitions, passing args ahead of each partition along with kwargs.  Returns
+        a dict mapping partitions to results, or raises PartitionError if any partition failed.
+        """
+        if self._resume is not None:
+            (results, errors, partitions), self._resume = self._resume, None
+        else:
+            results, errors = {}, {}
+            partitions = self.partitions() if callable(self.partitions) else self.partitions
+
+        pool = self.EXECUTORS[self.executor](max_workers=self.workers)
+        not_done = ()
+        try:
+            futures = {pool.submit(self.func, *(args + (partition,)), **kwargs): partition for partition in partitions}
+            _, not_done = wait(futures, timeout=self.timeout)
+            for future in not_done:
+                future.cancel()
+        finally:
+            if not_done:
+                self._terminate_workers(pool)
+            else:
+                pool.shutdown()
+
+        for future, partition in futures.items():
+            if future.cancelled() or not future.done():
+                errors[partition] = concurrent.futures.TimeoutError(
+                    'Partition did not finish within {} seconds'.format(self.timeout))
+            elif future.exception() is not None:
+                errors[partition] = future.exception()
+            else:
+                results[partition] = future.result()
+
+        if errors:
+            logger = daiquiri.getLogger(self.name)
+            for partition, error in errors.items():
+                logger.error('Partition {!r} failed: {!r}'.format(partition, error))
+            raise PartitionError(results, errors)
+        return results
@@ -7,12 +7,25 @@ try:  # pragma: no cover
 except:  # noqa  pragma: no cover
     from queue import Empty
 
-from multiprocessing import Process, Queue
+from collections import defaultdict, deque, OrderedDict
+from multiprocessing import Event, Process, Queue
 import datetime
+import heapq
+import itertools
+import selectors
+import signal
 import sys
 
 
 class SubProcess:
+    JOIN_SECONDS = 5
+
+    # There is one of these per tab, so keep them small
+    __slots__ = (
+        'q_stdout', 'q_stderr', 'q_error', '_robust', '_until', '_name', '_target', '_args', '_process',
+        '_kwargs', '_has_logged_expiration', '_is_expired', 'daemon', '_max_rss_mb', '_recycle_event',
+    )
+
     def __init__(
             self,
             name,
@@ -40,7 +53,7 @@ class SubProcess:
         self._target = target
 
         # Save the args to the process
-        self._args = args or set()
+        self._args = args or ()
 
         # Setup a reference to the process
         self._process = None
@@ -49,22 +62,71 @@ class SubProcess:
         self._kwargs = kwargs or {}
 
         self._has_logged_expiration = False
+        self._is_expired = False
+
+        # Daemonic processes are not allowed to start processes of their own
+        self.daemon = True
+
+        # Memory threshold and the event used to ask the process to recycle itself
+        self._max_rss_mb = None
+        self._recycle_event = None
+
+    def set_recycle(self, max_rss_mb, recycle_event):
+        """
+        Have the monitor ask this process to recycle itself between runs once its
+        resident memory exceeds max_rss_mb.
+        """
+        self._max_rss_mb = max_rss_mb
+        self._recycle_event = recycle_event
+
+    def check_memory(self):
+        """
+        Sample the resident memory of the process and request a recycle if it is too large
+        """
+        if self._max_rss_mb is None or not self.is_alive() or self._recycle_event.is_set():
+            return
+        rss_mb = read_rss_mb(self._process.pid)
+        if rss_mb is not None and rss_mb > self._max_rss_mb:
+            logger = daiquiri.getLogger(self._name)
+            logger.info('Resident memory {:.1f}MB exceeds {}MB. Recycling after current run.'.format(
+                rss_mb, self._max_rss_mb))
+            self._recycle_event.set()
+
+    def expire(self):
+        if not self._has_logged_expiration:
+            self._has_logged_expiration = True
+            logger = daiquiri.getLogger(self._name)
+            logger.info('Process expired and will no longer run')
+        self._is_expired = True
 
     @property
     def expired(self):
-        expired = False
-        if self._until is not None and self._until < datetime.datetime.now():
-            expired = True
-            if not self._has_logged_expiration:
-                self._has_logged_expiration = True
-                logger = daiquiri.getLogger(self._name)
-                logger.info('Process expired and will no longer run')
-        return expired
+        if not self._is_expired and self._until is not None and self._until < datetime.datetime.now():
+            self.expire()
+        return self._is_expired
 
     def is_alive(self):
         return self._process is not None and self._process.is_alive()
 
+    @property
+    def pid(self):
+        return None if self._process is None else self._process.pid
+
+    @property
+    def sentinel(self):
+        return None if self._process is None else self._process.sentinel
+
+    def join(self, timeout=None):
+        self._process.join(timeout)
+
+    def terminate(self):
+        if self.is_alive():
+            self._process.terminate()
+            self._process.join(timeout=self.JOIN_SECONDS)
+
     def start(self):
+        if self._recycle_event is not None:
+            self._recycle_event.clear()
 
         self._process = Process(
             target=wrapped_target,
@@ -74,10 +136,25 @@ class SubProcess:
             ] + list(self._args),
             kwargs=self._kwargs
         )
-        self._process.daemon = True
+        self._process.daemon = self.daemon
         self._process.start()
 
 
+def read_rss_mb(pid):
+    """
+    Returns the resident memory of a process in megabytes, or None if it can't be read.
+    This relies on the /proc filesystem, so it only works on Linux.
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as buff:
+            for line in buff:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
 class IOQueue:  # pragma: no cover
     """
     Okay, so here is something annoying.  If you spawn a python subprocess, you cannot
@@ -121,18 +198,119 @@ def wrapped_target(target, q_stdout, q_stderr, q_error, robust, name, *args, **k
         raise
 
 
+class AdmissionController:
+    MAX_EXITED_PIDS = 1024
+
+    def __init__(self, max_concurrent_runs):
+        """
+        Limits the number of tab runs that execute at the same time across all tab
+        processes.  Tab processes send "acquire" events with a (priority, pid, one_shot)
+        payload and wait for their grant event to be set.  Waiting runs are admitted lowest
+        priority value first, and in request order within a priority.
+        """
+        self._max_concurrent_runs = max_concurrent_runs
+        self._grant_events = {}
+        self._waiting = []
+        self._counter = itertools.count()
+        # maps the pid of each admitted process to the (name, one_shot) key of its grant event
+        self._running = {}
+        # pids of recently exited processes, whose acquire events may still be queued
+        self._exited = OrderedDict()
+
+    def grant_event(self, name, one_shot=False):
+        """
+        Returns the event set when a run of the named tab is admitted.  A tab has at most
+        one resident process and one process running it once after an upstream tab, and
+        each of them waits on its own event.
+        """
+        key = (name, one_shot)
+        if key not in self._grant_events:
+            self._grant_events[key] = Event()
+        return self._grant_events[key]
+
+    def handle_event(self, kind, name, payload):
+        if kind == 'acquire':
+            priority, pid, one_shot = payload
+            if pid in self._exited:
+                return
+            heapq.heappush(self._waiting, (priority, next(self._counter), (name, one_shot), pid))
+        elif kind == 'release':
+            self._running.pop(payload, None)
+        elif kind == 'exited':
+            self._forget_process(payload)
+            self._exited[payload] = None
+            if len(self._exited) > self.MAX_EXITED_PIDS:
+                self._exited.popitem(last=False)
+        elif kind == 'started':
+            # the pid was reused
+            self._exited.pop(payload, None)
+            return
+        else:
+            return
+        self._admit()
+
+    def _forget_process(self, pid):
+        keys = [w[2] for w in self._waiting if w[3] == pid]
+        if keys:
+            self._waiting = [w for w in self._waiting if w[3] != pid]
+            heapq.heapify(self._waiting)
+        if pid in self._running:
+            keys.append(self._running.pop(pid))
+        for key in keys:
+            # a grant the process didn't live to consume must not admit the next process
+            self._grant_events[key].clear()
+
+    def _admit(self):
+        while self._waiting and len(self._running) < self._max_concurrent_runs:
+            _, _, key, pid = heapq.heappop(self._waiting)
+            self._running[pid] = key
+            self.grant_event(*key).set()
+
+
 class ProcessMonitor:
     TIMEOUT_SECONDS = .05
+    RSS_SAMPLE_SECONDS = 1
 
     def __init__(self):
-
-        self._subprocesses = []
+        # subprocesses that are restarted when they exit, indexed by name
+        self._subprocesses = OrderedDict()
+        # subprocesses that run once, indexed by name
+        self._one_shots = defaultdict(list)
+        # maps the sentinel of every started process to its subprocess
+        self._sentinels = {}
+        # watches the same sentinels, so finding exited processes doesn't scan every process
+        self._selector = selectors.DefaultSelector()
+        # subprocesses waiting to be (re)started
+        self._pending = deque()
+        # (until, sequence, subprocess) entries ordered by expiry time
+        self._expiry_heap = []
+        self._sequence = itertools.count()
+        # names of subprocesses whose memory is sampled
+        self._memory_watched = set()
+        # names of subprocesses that may start processes of their own
+        self._non_daemonic = set()
+        # maps names of on demand subprocesses to functions giving their next start time
+        self._spawn_time_funcs = {}
+        # (start_time, sequence, subprocess, kwargs) entries for on demand subprocesses
+        self._spawn_heap = []
+        # set by the SIGCHLD handler when a child process has exited
+        self._child_exited = True
+        self._use_child_signal = False
+        self._previous_child_handler = None
+
+        self._hooks = []
+        self._event_handlers = []
+        self._last_rss_sample = None
         self._is_running = False
         self.q_stdout = Queue()
         self.q_stderr = Queue()
         self.q_error = Queue()
+        # Child processes report events such as completed runs on this queue
+        self.q_event = Queue()
 
     def add_subprocess(self, name, func, robust, until, *args, **kwargs):
+        if name in self._subprocesses:
+            raise ValueError('A subprocess named {} already exists'.format(name))
         sub = SubProcess(
             name,
             target=func,
@@ -144,7 +322,205 @@ class ProcessMonitor:
             args=args,
             kwargs=kwargs
         )
-        self._subprocesses.append(sub)
+        self._subprocesses[name] = sub
+        self._pending.append(sub)
+        if until is not None:
+            heapq.heappush(self._expiry_heap, (until, next(self._sequence), sub))
+        return sub
+
+    def watch_memory(self, name, max_rss_mb, recycle_event):
+        """
+        Ask the named subprocess to recycle itself between runs once its resident
+        memory exceeds max_rss_mb.
+        """
+        sub = self._subprocesses[name]
+        sub.set_recycle(max_rss_mb, recycle_event)
+        if max_rss_mb is not None:
+            self._memory_watched.add(name)
+
+    def _forget(self, name):
+        # entries left in the pending queue and expiry heap are skipped once forgotten
+        self._memory_watched.discard(name)
+        self._spawn_time_funcs.pop(name, None)
+        return self._subprocesses.pop(name, None)
+
+    def remove_subprocess(self, name):
+        """
+        Stops and forgets the subprocess with the given name.  Other subprocesses
+        are left untouched.  Returns True if anything was removed.
+        """
+        removed = self._one_shots.pop(name, [])
+        sub = self._forget(name)
+        if sub is not None:
+            removed.append(sub)
+        for sub in removed:
+            self._unwatch(sub)
+            sub.terminate()
+            if sub.pid is not None:
+                self.dispatch_event('exited', name, sub.pid)
+        return bool(removed)
+
+    def spawn_on_demand(self, name, spawn_time_func):
+        """
+        Rather than restarting the named subprocess as soon as it exits, start it later.
+        spawn_time_func(now) returns a (start_time, kwargs) tuple, where kwargs are passed
+        to the target of the process it starts.
+        """
+        self._spawn_time_funcs[name] = spawn_time_func
+
+    def allow_children(self, name):
+        """
+        Run processes with this name non-daemonic so they can start worker processes.
+        The monitor terminates them when its loop exits.
+        """
+        self._non_daemonic.add(name)
+
+    def _start(self, sub):
+        sub.daemon = sub._name not in self._non_daemonic
+        sub.start()
+        self._sentinels[sub.sentinel] = sub
+        self._selector.register(sub.sentinel, selectors.EVENT_READ, sub)
+        self.dispatch_event('started', sub._name, sub.pid)
+
+    def _unwatch(self, sub):
+        if self._sentinels.pop(sub.sentinel, None) is not None:
+            self._selector.unregister(sub.sentinel)
+
+    def run_once(self, name, func, robust, *args, **kwargs):
+        """
+        Start a process that runs func a single time and is not restarted when it exits.
+        """
+        sub = SubProcess(
+            name,
+            target=func,
+            q_stdout=self.q_stdout,
+            q_stderr=self.q_stderr,
+            q_error=self.q_error,
+            robust=robust,
+            args=args,
+            kwargs=kwargs
+        )
+        self._start(sub)
+        self._one_shots[name].append(sub)
+        return sub
+
+    def has_one_shot(self, name):
+        return name in self._one_shots
+
+    def _handle_child_signal(self, signum, frame):  # pragma: no cover
+        self._child_exited = True
+
+    def _install_child_signal(self):
+        """
+        Only look for exited processes after SIGCHLD reports that one exited.  Where the
+        signal can't be used, look on every pass instead.
+        """
+        self._child_exited = True
+        try:
+            self._previous_child_handler = signal.signal(signal.SIGCHLD, self._handle_child_signal)
+            self._use_child_signal = True
+        except (AttributeError, ValueError):  # pragma: no cover  no SIGCHLD or not the main thread
+            self._use_child_signal = False
+
+    def _restore_child_signal(self):
+        if self._use_child_signal:
+            signal.signal(signal.SIGCHLD, self._previous_child_handler)
+            self._use_child_signal = False
+
+    def reap(self):
+        """
+        Handle processes that have exited since the last pass.  Restartable processes are
+        queued to be started again and one-shot processes are dropped.
+        """
+        if self._use_child_signal:
+            if not self._child_exited:
+                return
+            self._child_exited = False
+
+        for key, _ in self._selector.select(timeout=0):
+            sub = key.data
+            self._unwatch(sub)
+            # wait for the process to be fully reaped so is_alive() agrees with the sentinel
+            sub.join()
+            self.dispatch_event('exited', sub._name, sub.pid)
+            if self._subprocesses.get(sub._name) is sub:
+                self._pending.append(sub)
+            elif sub in self._one_shots.get(sub._name, []):
+                self._one_shots[sub._name].remove(sub)
+                if not self._one_shots[sub._name]:
+                    del self._one_shots[sub._name]
+
+    def expire(self):
+        now = datetime.datetime.now()
+        while self._expiry_heap and self._expiry_heap[0][0] < now:
+            _, _, sub = heapq.heappop(self._expiry_heap)
+            if self._subprocesses.get(sub._name) is sub:
+                sub.expire()
+
+    def _is_current(self, sub):
+        return self._subprocesses.get(sub._name) is sub and not sub.expired
+
+    def start_pending(self):
+        now = datetime.datetime.now()
+        while self._pending:
+            sub = self._pending.popleft()
+            if not self._is_current(sub):
+                continue
+            spawn_time_func = self._spawn_time_funcs.get(sub._name)
+            if spawn_time_func is None:
+                self._start(sub)
+            else:
+                start_time, kwargs = spawn_time_func(now)
+                heapq.heappush(self._spawn_heap, (start_time, next(self._sequence), sub, kwargs))
+
+        while self._spawn_heap and self._spawn_heap[0][0] <= now:
+            _, _, sub, kwargs = heapq.heappop(self._spawn_heap)
+            if self._is_current(sub):
+                sub._kwargs = kwargs
+                self._start(sub)
+
+    def add_event_handler(self, handler):
+        """
+        Register a callable that is invoked as handler(kind, name, payload) for every
+        event a child process puts on the event queue.  The monitor itself dispatches
+        "started" and "exited" events with the pid as payload whenever it starts a process
+        or sees one has ended.
+        """
+        self._event_handlers.append(handler)
+
+    def dispatch_event(self, kind, name, payload):
+        for handler in list(self._event_handlers):
+            handler(kind, name, payload)
+
+    def process_event_queue(self, event_queue):
+        while True:
+            try:
+                kind, name, payload = event_queue.get_nowait()
+            except Empty:
+                return
+            self.dispatch_event(kind, name, payload)
+
+    def add_hook(self, hook):
+        """
+        Register a callable with no arguments that will be invoked on every
+        pass of the main loop.
+        """
+        self._hooks.append(hook)
+
+    def check_memory(self):
+        if not self._memory_watched:
+            return
+        now = datetime.datetime.now()
+        if self._last_rss_sample is not None:
+            if (now - self._last_rss_sample).total_seconds() < self.RSS_SAMPLE_SECONDS:
+                return
+        self._last_rss_sample = now
+        for name in self._memory_watched:
+            self._subprocesses[name].check_memory()
+
+    @property
+    def is_running(self):
+        return self._is_running
 
     def process_io_queue(self, q, stream):
         try:
@@ -161,7 +537,7 @@ class ProcessMonitor:
             error_name = error_queue.get(timeout=self.TIMEOUT_SECONDS)
             if error_name:
                 error_name = error_name.strip()
-                self._subprocesses = [s for s in self._subprocesses if s._name != error_name]
+                self._forget(error_name)
                 logger = daiquiri.getLogger(error_name)
                 logger.info('Will not auto-restart because it\'s not robust')
 
@@ -175,17 +551,36 @@ class ProcessMonitor:
         loop_started = datetime.datetime.now()
 
         self._is_running = True
-        while self._is_running:
-            self.process_error_queue(self.q_error)
-
-            if max_seconds is not None:
-                if (datetime.datetime.now() - loop_started).total_seconds() > max_seconds:
-                    logger = daiquiri.getLogger('crontabs')
-                    logger.info('Crontabs reached specified timeout.  Exiting.')
-                    break
-            for subprocess in self._subprocesses:
-                if not subprocess.is_alive() and not subprocess.expired:
-                    subprocess.start()
-
-            self.process_io_queue(self.q_stdout, sys.stdout)
-            self.process_io_queue(self.q_stderr, sys.stderr)
+        self._install_child_signal()
+        try:
+            while self._is_running:
+                self.process_error_queue(self.q_error)
+                self.process_event_queue(self.q_event)
+
+                if max_seconds is not None:
+                    if (datetime.datetime.now() - loop_started).total_seconds() > max_seconds:
+                        logger = daiquiri.getLogger('crontabs')
+                        logger.info('Crontabs reached specified timeout.  Exiting.')
+                        break
+                for hook in list(self._hooks):
+                    hook()
+
+                self.check_memory()
+                self.expire()
+                self.reap()
+                self.start_pending()
+
+                self.process_io_queue(self.q_stdout, sys.stdout)
+                self.process_io_queue(self.q_stderr, sys.stderr)
+        finally:
+            self._is_running = False
+            self._restore_child_signal()
+            self.terminate_non_daemonic()
+
+    def terminate_non_daemonic(self):
+        """
+        Python waits for non-daemonic children when it exits, so stop them with the loop
+        """
+        for sub in list(self._sentinels.values()):
+            if not sub.daemon:
+                sub.terminate()
@@ -1,13 +1,27 @@
 from collections import Counter
-from unittest import TestCase
+from unittest import TestCase, mock
+import concurrent.futures
+import ctypes
 import datetime
 import functools
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
 import sys
+import tempfile
 import time
 
 from crontabs import Cron, Tab
+from crontabs.crontabs import ConfigWatcher, _parse_date
+from crontabs.partitions import PartitionError
+from crontabs.processes import AdmissionController, read_rss_mb
+from crontabs.timezones import UtcOffsetTable, from_seconds, get_offset_table, get_timezone, to_seconds
+from crontabs.triggers import DirectoryTrigger, FileTrigger, Inotify, coalesce
 from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
+from dateutil import tz
 import fleming
 
 Tab._SILENCE_LOGGER = True
@@ -292,3 +306,1006 @@ class TestStartingOnNextInterval(TestCase):
             cron.go(max_seconds=5)
 
         assert('func_was_called' in catcher.text)
+
+
+CONFIG_TEMPLATE = """
+from crontabs import Tab
+from crontabs.tests.test_all import time_logger
+
+tabs = [
+    Tab('steady', verbose=False).every(seconds=1).run(time_logger, 'steady'),
+    Tab('changing', verbose=False).every(seconds={seconds}).run(time_logger, 'changing'),
+]
+"""
+
+
+class TestHotReload(TestCase):
+    def setUp(self):
+        self.cron = Cron()
+        # pretend the monitor loop is active so changes are registered right away
+        self.cron.monitor._is_running = True
+
+    def subprocess_lookup(self):
+        return dict(self.cron.monitor._subprocesses)
+
+    def test_add_and_remove(self):
+        self.cron.add(Tab('a').every(seconds=1).run(time_logger, 'a'))
+        self.cron.add(Tab('b').every(seconds=1).run(time_logger, 'b'))
+        self.assertEqual(set(self.subprocess_lookup()), {'a', 'b'})
+
+        with self.assertRaises(ValueError):
+            self.cron.add(Tab('a').every(seconds=1).run(time_logger, 'a'))
+
+        self.cron.remove('a')
+        self.assertEqual(set(self.subprocess_lookup()), {'b'})
+        self.assertEqual([t._name for t in self.cron._tab_list], ['b'])
+
+        with self.assertRaises(ValueError):
+            self.cron.remove('a')
+
+    def test_reload_only_touches_changed_tabs(self):
+        self.cron.add(Tab('same').every(seconds=1).run(time_logger, 'same'))
+        self.cron.add(Tab('changed').every(seconds=1).run(time_logger, 'changed'))
+        self.cron.add(Tab('dropped').every(seconds=1).run(time_logger, 'dropped'))
+        before = self.subprocess_lookup()
+
+        self.cron.reload(
+            Tab('same').every(seconds=1).run(time_logger, 'same'),
+            Tab('changed').every(seconds=2).run(time_logger, 'changed'),
+            Tab('new').every(seconds=1).run(time_logger, 'new'),
+        )
+        after = self.subprocess_lookup()
+
+        self.assertEqual(set(after), {'same', 'changed', 'new'})
+        self.assertIs(before['same'], after['same'])
+        self.assertIsNot(before['changed'], after['changed'])
+
+    def test_config_watcher(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'tabs.py')
+
+        with open(path, 'w') as buff:
+            buff.write(CONFIG_TEMPLATE.format(seconds=1))
+        watcher = ConfigWatcher(self.cron, path, interval_seconds=0)
+        watcher()
+        before = self.subprocess_lookup()
+        self.assertEqual(set(before), {'steady', 'changing'})
+
+        # an unmodified file is not reloaded
+        watcher()
+        self.assertEqual(self.subprocess_lookup(), before)
+
+        with open(path, 'w') as buff:
+            buff.write(CONFIG_TEMPLATE.format(seconds=2))
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        watcher()
+        after = self.subprocess_lookup()
+        self.assertIs(before['steady'], after['steady'])
+        self.assertIsNot(before['changing'], after['changing'])
+
+    def test_invalid_reload_changes_nothing(self):
+        self.cron.add(Tab('a').every(seconds=1).run(time_logger, 'a'))
+        self.cron.add(Tab('b').every(seconds=1).run(time_logger, 'b'))
+        before = self.subprocess_lookup()
+        for tabs in [
+            [Tab('a').every(seconds=2).run(time_logger, 'a'), Tab('c').every(seconds=1)],
+            [Tab('c').every(seconds=1).run(func), Tab('c').every(seconds=2).run(func)],
+        ]:
+            with self.assertRaises(ValueError):
+                self.cron.reload(*tabs)
+            self.assertEqual(self.subprocess_lookup(), before)
+            self.assertEqual([t._name for t in self.cron._tab_list], ['a', 'b'])
+
+    def test_config_watcher_survives_invalid_tabs(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'tabs.py')
+        with open(path, 'w') as buff:
+            buff.write('from crontabs import Tab\ntabs = [Tab("a").every(seconds=1)]\n')
+
+        self.cron.add(Tab('b').every(seconds=1).run(func))
+        before = self.subprocess_lookup()
+        ConfigWatcher(self.cron, path, interval_seconds=0)()
+        self.assertEqual(self.subprocess_lookup(), before)
+
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_bad_profile(self):
+        with self.assertRaises(ValueError):
+            Tab('a', profile='bad')
+
+    def test_unprofiled_tab(self):
+        tab = Tab('a').every(seconds=1).run(func)
+        self.assertIsNone(tab._profile_runs)
+        with self.assertRaises(ValueError):
+            tab.profile_next()
+        with self.assertRaises(ValueError):
+            Cron().schedule(tab).profile('a')
+
+    def test_profile_next_runs(self):
+        tab = Tab(
+            'profiled', verbose=False, profile=['cprofile', 'tracemalloc'], profile_dir=self.tmp_dir
+        ).every(seconds=1).run(return_true)
+        Cron().schedule(tab, Tab('plain').every(seconds=1).run(func)).profile(runs=2)
+
+        for _ in range(3):
+            self.assertTrue(tab._execute())
+
+        file_names = os.listdir(self.tmp_dir)
+        self.assertEqual(len([f for f in file_names if f.endswith('.prof')]), 2)
+        self.assertEqual(len([f for f in file_names if f.endswith('.tracemalloc')]), 2)
+        self.assertEqual(len([f for f in file_names if f.endswith('.tracemalloc.txt')]), 2)
+        self.assertEqual(tab._profile_runs.value, 0)
+
+    def test_signal_installed_for_added_tabs(self):
+        if Cron.PROFILE_SIGNAL is None:  # pragma: no cover
+            self.skipTest('requires SIGUSR1')
+        previous = signal.getsignal(Cron.PROFILE_SIGNAL)
+        self.addCleanup(signal.signal, Cron.PROFILE_SIGNAL, previous)
+
+        cron = Cron()
+        cron.monitor._is_running = True
+        cron.add(Tab('plain').every(seconds=1).run(func))
+        self.assertEqual(signal.getsignal(Cron.PROFILE_SIGNAL), previous)
+        cron.add(Tab('profiled', profile='cprofile', profile_dir=self.tmp_dir).every(seconds=1).run(func))
+        self.assertEqual(signal.getsignal(Cron.PROFILE_SIGNAL), cron._handle_profile_signal)
+        cron.remove('plain')
+        cron.remove('profiled')
+
+
+def pid_logger():  # pragma: no cover
+    print('pid={}'.format(os.getpid()))
+
+
+class TestRecycling(TestCase):
+    def count_pids(self, text):
+        return len({line for line in text.split('\n') if line.startswith('pid=')})
+
+    def test_read_rss(self):
+        if not os.path.exists('/proc/self/status'):  # pragma: no cover
+            self.skipTest('requires the /proc filesystem')
+        self.assertGreater(read_rss_mb(os.getpid()), 0)
+        self.assertIsNone(read_rss_mb(-1))
+
+    def test_max_runs_ends_loop(self):
+        tab = Tab('runs', verbose=False, max_runs=2).every(seconds=1).run(time_logger, 'runs')
+        with PrintCatcher() as catcher:
+            tab._loop()
+        self.assertEqual(catcher.text.count('runs'), 2)
+
+    def test_recycle_before_first_run_is_ignored(self):
+        tab = Tab('rss', verbose=False, max_rss_mb=1).every(seconds=1).run(time_logger, 'rss')
+        tab._recycle_event.set()
+        self.assertFalse(tab._should_recycle(0))
+        self.assertTrue(tab._should_recycle(1))
+
+    def test_rss_recycles_process(self):
+        if not os.path.exists('/proc/self/status'):  # pragma: no cover
+            self.skipTest('requires the /proc filesystem')
+        cron = Cron().schedule(
+            Tab('rss', verbose=False, max_rss_mb=1).every(seconds=1).run(pid_logger),
+            Tab('steady', verbose=False).every(seconds=1).run(pid_logger),
+        )
+        with PrintCatcher() as catcher:
+            cron.go(max_seconds=4.5)
+        # the steady tab keeps one process while the rss tab gets a new one each run
+        self.assertGreaterEqual(self.count_pids(catcher.text), 4)
+
+
+def produce_stamp():  # pragma: no cover
+    return datetime.datetime.now().isoformat()
+
+
+def consume_stamp(stamp, label):  # pragma: no cover
+    lag = datetime.datetime.now() - parse(stamp)
+    print('{} lag {}'.format(label, lag.total_seconds()))
+
+
+class TestChaining(TestCase):
+    def test_after_self(self):
+        with self.assertRaises(ValueError):
+            Tab('a').after('a')
+
+    def test_triggered_needs_run(self):
+        with self.assertRaises(ValueError):
+            Cron().schedule(Tab('b').after('a')).go(max_seconds=0)
+
+    def test_notify_success(self):
+        tab = Tab('a', verbose=False).every(seconds=1).run(return_true)
+        tab._event_queue = queue.Queue()
+        tab._notify_success(tab._execute())
+        tab._send_result = ctypes.c_bool(True)
+        tab._notify_success(tab._execute())
+        tab._notify_success(b'x' * (Tab.MAX_RESULT_BYTES + 1))
+        tab._notify_success(lambda: None)
+        events = [tab._event_queue.get_nowait() for _ in range(4)]
+        self.assertEqual(events, [('success', 'a', None), ('success', 'a', True)] + [('success', 'a', None)] * 2)
+
+    def test_results_sent_only_when_used(self):
+        cron = Cron()
+        cron.monitor._is_running = True
+        upstream = Tab('upstream').every(seconds=1).run(return_true)
+        cron.add(upstream)
+        cron.add(Tab('plain').after('upstream').run(func))
+        self.assertFalse(upstream._send_result.value)
+        before = cron.monitor._subprocesses['upstream']
+
+        cron.add(Tab('consumer').after('upstream', pass_result=True).run(func))
+        self.assertTrue(upstream._send_result.value)
+        # the running upstream tab is left alone
+        self.assertIs(cron.monitor._subprocesses['upstream'], before)
+
+        self.assertEqual([t._name for t in cron._downstream['upstream']], ['plain', 'consumer'])
+        cron.remove('plain')
+        cron.remove('consumer')
+        self.assertEqual(cron._downstream, {})
+
+    def test_scheduled_runs_with_pass_result(self):
+        with self.assertRaises(ValueError):
+            Tab('both').every(seconds=1).after('upstream', pass_result=True).run(func)._get_target()
+
+    def test_downstream_runs_after_upstream(self):
+        cron = Cron().schedule(
+            Tab('upstream', verbose=False).every(seconds=1).run(produce_stamp),
+            Tab('downstream', verbose=False).after('upstream', pass_result=True).run(consume_stamp, 'down'),
+        )
+        with PrintCatcher() as catcher:
+            cron.go(max_seconds=3.5)
+
+        lags = [float(line.split()[-1]) for line in catcher.text.split('\n') if line.startswith('down lag')]
+        self.assertGreaterEqual(len(lags), 2)
+        # the downstream tab fires well within the upstream interval
+        self.assertLess(max(lags), 1)
+
+
+def event_logger(events, label):  # pragma: no cover
+    print('{} {}'.format(label, ','.join(str(e) for e in events)))
+
+
+class TestTriggers(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'watched.txt')
+
+    def write(self, path, text):
+        with open(path, 'w') as buff:
+            buff.write(text)
+
+    def inotify_modes(self):
+        return [True, False] if Inotify.is_available() else [False]
+
+    def test_memory_friendly_trigger(self):
+        with self.assertRaises(ValueError):
+            Tab('a', memory_friendly=True).on_queue(queue.Queue()).run(func)._get_target()
+
+    def test_file_trigger(self):
+        for use_inotify in self.inotify_modes():
+            trigger = FileTrigger(self.path, poll_seconds=.01, use_inotify=use_inotify)
+            self.addCleanup(trigger.close)
+            self.assertEqual(trigger.wait(.05), [])
+
+            self.write(os.path.join(self.tmp_dir, 'other.txt'), 'ignored')
+            self.assertEqual(trigger.wait(.05), [])
+
+            self.write(self.path, 'first')
+            events = coalesce(trigger, trigger.wait(1), .05, .5)
+            self.assertEqual(events, [self.path])
+
+            os.remove(self.path)
+            self.assertEqual(coalesce(trigger, trigger.wait(1), .05, .5), [self.path])
+
+    def test_directory_trigger(self):
+        for use_inotify in self.inotify_modes():
+            trigger = DirectoryTrigger(self.tmp_dir, poll_seconds=.01, use_inotify=use_inotify)
+            self.addCleanup(trigger.close)
+            a, b = os.path.join(self.tmp_dir, 'a'), os.path.join(self.tmp_dir, 'b')
+            self.write(a, 'a')
+            self.write(b, 'b')
+            events = coalesce(trigger, trigger.wait(1), .05, .5)
+            self.assertEqual(sorted(events), [a, b])
+
+            os.remove(a)
+            os.remove(b)
+            self.assertEqual(sorted(coalesce(trigger, trigger.wait(1), .05, .5)), [a, b])
+
+    def test_missing_directory(self):
+        path = os.path.join(self.tmp_dir, 'later')
+        for use_inotify in self.inotify_modes():
+            trigger = DirectoryTrigger(path, poll_seconds=.01, use_inotify=use_inotify)
+            self.addCleanup(trigger.close)
+            self.assertEqual(trigger.wait(.05), [])
+
+            os.mkdir(path)
+            self.write(os.path.join(path, 'a'), 'a')
+            self.assertEqual(coalesce(trigger, trigger.wait(1), .05, .5), [os.path.join(path, 'a')])
+
+            self.write(os.path.join(path, 'b'), 'b')
+            self.assertEqual(coalesce(trigger, trigger.wait(1), .05, .5), [os.path.join(path, 'b')])
+
+            # a directory that is removed and created again is watched again
+            shutil.rmtree(path)
+            coalesce(trigger, trigger.wait(1), .05, .5)
+            self.assertEqual(trigger.wait(.05), [])
+            os.mkdir(path)
+            self.write(os.path.join(path, 'c'), 'c')
+            self.assertEqual(coalesce(trigger, trigger.wait(1), .05, .5), [os.path.join(path, 'c')])
+            shutil.rmtree(path)
+
+    def test_queue_trigger_coalesces(self):
+        q = queue.Queue()
+        for num in range(3):
+            q.put(num)
+        tab = Tab('queued', verbose=False).on_queue(q).run(event_logger, 'queued')
+        with PrintCatcher() as catcher:
+            tab._trigger_loop(max_runs=1)
+        self.assertEqual(catcher.text.strip(), 'queued 0,1,2')
+
+    def test_bad_trigger_combinations(self):
+        with self.assertRaises(ValueError):
+            Tab('a').on_queue(queue.Queue()).on_file_change(self.path)
+        with self.assertRaises(ValueError):
+            Tab('a').on_queue(queue.Queue()).every(seconds=1).run(func)._get_target()
+        Tab('a').on_queue(queue.Queue()).run(func)._get_target()
+
+    def test_file_change_runs_tab(self):
+        def touch():
+            if not os.path.exists(self.path):
+                self.write(self.path, 'changed')
+
+        cron = Cron().schedule(
+            Tab('watcher', verbose=False).on_file_change(
+                self.path, pass_events=True).run(event_logger, 'changed')
+        )
+        started = time.time()
+        cron.monitor.add_hook(lambda: time.time() - started > 1 and touch())
+        with PrintCatcher() as catcher:
+            cron.go(max_seconds=2.5)
+        self.assertEqual(catcher.text.strip(), 'changed {}'.format(self.path))
+
+
+def span_logger(label):  # pragma: no cover
+    started = time.time()
+    time.sleep(.4)
+    print('span {} {} {}'.format(label, started, time.time()))
+
+
+class TestThunderingHerd(TestCase):
+    def test_spread_offset(self):
+        offsets = {Tab('tab_{}'.format(num), spread=60)._spread_offset() for num in range(20)}
+        self.assertGreater(len(offsets), 10)
+        for offset in offsets:
+            self.assertTrue(datetime.timedelta(0) <= offset < datetime.timedelta(seconds=60))
+        self.assertEqual(Tab('a', spread=60)._spread_offset(), Tab('a', spread=60)._spread_offset())
+        self.assertEqual(Tab('a')._spread_offset(), datetime.timedelta(0))
+        self.assertEqual(Tab('a', spread=.001)._spread_offset(), datetime.timedelta(0))
+        for spread in [.0005, -1]:
+            with self.assertRaises(ValueError):
+                Tab('a', spread=spread)
+
+    def test_spread_loop(self):
+        tab = Tab('spread', verbose=False, spread=.9).every(seconds=1).run(time_logger, 'spread')
+        with PrintCatcher() as catcher:
+            tab._loop(max_iter=2)
+        offset = tab._spread_offset().total_seconds()
+        for line in catcher.text.strip().split('\n'):
+            fraction = parse(line.split(' ', 1)[1]).microsecond / 1e6
+            self.assertAlmostEqual(fraction, offset, delta=.1)
+
+    def test_admission_priorities(self):
+        controller = AdmissionController(1)
+        controller.handle_event('acquire', 'a', (5, 1, False))
+        controller.handle_event('acquire', 'b', (1, 2, False))
+        controller.handle_event('acquire', 'c', (0, 3, False))
+        self.assertTrue(controller.grant_event('a').is_set())
+        self.assertFalse(controller.grant_event('c').is_set())
+
+        controller.handle_event('release', 'a', 1)
+        self.assertTrue(controller.grant_event('c').is_set())
+        self.assertFalse(controller.grant_event('b').is_set())
+
+        # a process that dies while admitted frees its slot
+        controller.handle_event('exited', 'c', 3)
+        self.assertTrue(controller.grant_event('b').is_set())
+        # a grant that was never consumed doesn't outlive its process
+        controller.handle_event('exited', 'b', 2)
+        self.assertFalse(controller.grant_event('b').is_set())
+
+    def test_acquire_after_exit(self):
+        controller = AdmissionController(1)
+        # the acquire of a process terminated while it was still queued
+        controller.handle_event('exited', 'a', 1)
+        controller.handle_event('acquire', 'a', (0, 1, False))
+        self.assertFalse(controller.grant_event('a').is_set())
+        controller.handle_event('acquire', 'b', (0, 2, False))
+        self.assertTrue(controller.grant_event('b').is_set())
+
+        # a reused pid is admitted again
+        controller.handle_event('release', 'b', 2)
+        controller.handle_event('started', 'a', 1)
+        controller.handle_event('acquire', 'a', (0, 1, False))
+        self.assertTrue(controller.grant_event('a').is_set())
+
+    def test_one_shot_admission(self):
+        controller = AdmissionController(1)
+        controller.handle_event('acquire', 'a', (0, 1, False))
+        controller.handle_event('acquire', 'a', (0, 2, True))
+        self.assertTrue(controller.grant_event('a').is_set())
+        self.assertFalse(controller.grant_event('a', one_shot=True).is_set())
+        controller.grant_event('a').clear()
+        controller.handle_event('release', 'a', 1)
+        self.assertFalse(controller.grant_event('a').is_set())
+        self.assertTrue(controller.grant_event('a', one_shot=True).is_set())
+
+    def test_one_shot_waits_on_own_event(self):
+        cron = Cron(max_concurrent_runs=1)
+        cron.monitor._is_running = True
+        tab = Tab('both', verbose=False).every(seconds=1).after('upstream').run(return_true)
+        cron.add(tab)
+        tab._event_queue = queue.Queue()
+        cron._admission.grant_event('both', one_shot=True).set()
+
+        tab._get_trigger_target(None)()
+        self.assertEqual(tab._event_queue.get_nowait(), ('acquire', 'both', (0, os.getpid(), True)))
+        self.assertIsNot(tab._admission_event, cron._admission.grant_event('both'))
+        self.assertFalse(cron._admission.grant_event('both', one_shot=True).is_set())
+
+    def assert_no_overlap(self, text):
+        spans = sorted(
+            (float(words[2]), float(words[3])) for words in
+            (line.split() for line in text.split('\n')) if words and words[0] == 'span'
+        )
+        self.assertGreaterEqual(len(spans), 4)
+        for (_, previous_end), (start, _) in zip(spans, spans[1:]):
+            self.assertLessEqual(previous_end, start)
+
+    def test_max_concurrent_runs(self):
+        cron = Cron(max_concurrent_runs=1, priorities={'second': 1}).schedule(
+            Tab('first', verbose=False).every(seconds=1).run(span_logger, 'first'),
+            Tab('second', verbose=False).every(seconds=1).run(span_logger, 'second'),
+        )
+        with PrintCatcher() as catcher:
+            cron.go(max_seconds=3.5)
+        self.assert_no_overlap(catcher.text)
+
+    def test_max_concurrent_runs_with_one_shots(self):
+        # while the blocker runs, both processes of the "both" tab wait for admission
+        cron = Cron(max_concurrent_runs=1, priorities={'upstream': 0, 'blocker': 1, 'both': 2}).schedule(
+            Tab('upstream', verbose=False).every(seconds=1).run(func),
+            Tab('blocker', verbose=False).every(seconds=1).run(span_logger, 'blocker'),
+            Tab('both', verbose=False).every(seconds=1).after('upstream').run(span_logger, 'both'),
+        )
+        with PrintCatcher() as catcher:
+            cron.go(max_seconds=3.5)
+        self.assertGreaterEqual(catcher.text.count('span both'), 2)
+        self.assert_no_overlap(catcher.text)
+
+
+class TestMilliseconds(TestCase):
+    def test_millisecond_ticks(self):
+        tab = Tab('fast', verbose=False).every(milliseconds=100).run(time_logger, 'fast')
+        self.assertEqual(tab._every_kwargs, {'millisecond': 100})
+        started = time.time()
+        with PrintCatcher() as catcher:
+            tab._fast_loop(max_iter=10)
+        elapsed = time.time() - started
+
+        self.assertEqual(catcher.text.count('fast'), 10)
+        self.assertTrue(.9 <= elapsed < 1.2)
+        for line in catcher.text.strip().split('\n'):
+            # ticks land just after 100ms boundaries of the wall clock
+            self.assertLess(parse(line.split(' ', 1)[1]).microsecond % 100000, 20000)
+
+    def test_millisecond_lasting(self):
+        tab = Tab('fast', verbose=False).every(milliseconds=100).lasting(milliseconds=350).run(time_logger, 'fast')
+        self.assertEqual(tab._lasting_delta, relativedelta(microseconds=350000))
+        tab._get_target()
+        with PrintCatcher() as catcher:
+            tab._fast_loop()
+        self.assertIn(catcher.text.count('fast'), [3, 4])
+
+    def test_rate_and_jitter(self):
+        # a small benchmark of how many runs happen and how late they land after their tick
+        for milliseconds in [100, 20]:
+            stamps = []
+            tab = Tab('fast', verbose=False).every(milliseconds=milliseconds).run(lambda: stamps.append(time.time()))
+            tab._fast_loop(max_iter=int(1000 / milliseconds))
+            rate = (len(stamps) - 1) / (stamps[-1] - stamps[0])
+            jitter_ms = sorted(1000 * stamp % milliseconds for stamp in stamps)
+            median, worst = jitter_ms[len(jitter_ms) // 2], jitter_ms[-1]
+            print('{}ms: {:.2f} runs/s, median jitter {:.2f}ms, max {:.2f}ms'.format(
+                milliseconds, rate, median, worst))
+            self.assertAlmostEqual(rate, 1000 / milliseconds, delta=.1 * 1000 / milliseconds)
+            self.assertLess(median, 5)
+
+    def test_millisecond_inhibited(self):
+        tab = Tab('fast', verbose=False).every(millisecond=50).excluding(return_true).run(time_logger, 'fast')
+        with PrintCatcher() as catcher:
+            tab._fast_loop(max_iter=3)
+        self.assertEqual(catcher.text, '')
+
+    def test_millisecond_target(self):
+        tab = Tab('fast').every(milliseconds=250).run(func)
+        self.assertEqual(tab._get_target(), tab._fast_loop)
+        with self.assertRaises(ValueError):
+            Tab('fast').every(milliseconds=0).run(func)._fast_loop()
+
+
+class TestMonitorScaling(TestCase):
+    def test_expiry_heap(self):
+        monitor = Cron().monitor
+        past = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        future = datetime.datetime.now() + datetime.timedelta(days=1)
+        for num in range(5):
+            monitor.add_subprocess('future_{}'.format(num), func, True, future)
+        expired = monitor.add_subprocess('past', func, True, past)
+        monitor.expire()
+        self.assertTrue(expired._is_expired)
+        self.assertEqual(len(monitor._expiry_heap), 5)
+        self.assertFalse(any(s._is_expired for s in monitor._subprocesses.values() if s is not expired))
+
+    def test_reap_waits_for_child_signal(self):
+        monitor = Cron().monitor
+        monitor._use_child_signal = True
+        monitor._child_exited = False
+        # a selector that would fail if it were looked at
+        monitor._selector = None
+        monitor.reap()
+
+    def test_restart_and_non_robust_removal(self):
+        monitor = Cron().monitor
+        monitor.add_subprocess('robust', func, True, None)
+        monitor.add_subprocess('fragile', func, False, None)
+        with PrintCatcher():
+            monitor.start_pending()
+            first = monitor._subprocesses['robust'].pid
+            monitor.q_error.put('fragile')
+            monitor.process_error_queue(monitor.q_error)
+            self.assertEqual(list(monitor._subprocesses), ['robust'])
+
+            started = time.time()
+            while monitor._subprocesses['robust'].pid == first and time.time() - started < 5:
+                time.sleep(.05)
+                monitor.reap()
+                monitor.start_pending()
+        self.assertNotEqual(monitor._subprocesses['robust'].pid, first)
+        # exited processes are no longer watched
+        self.assertEqual(len(monitor._selector.get_map()), len(monitor._sentinels))
+        monitor.remove_subprocess('robust')
+        self.assertEqual(len(monitor._selector.get_map()), 0)
+
+
+class Pool(object):
+    built = 0
+    closed = 0
+
+    def __init__(self):
+        Pool.built += 1
+        self.uses = 0
+
+    def close(self):
+        Pool.closed += 1
+
+
+def use_pool(pool, label):
+    pool.uses += 1
+    return (label, pool.uses)
+
+
+class TestSetupHooks(TestCase):
+    def setUp(self):
+        Pool.built = Pool.closed = 0
+
+    def test_resource_reused_across_runs(self):
+        tab = Tab('pooled', verbose=False).setup(Pool).teardown(Pool.close).every(seconds=1).run(use_pool, 'x')
+        self.assertEqual(tab._execute(), ('x', 1))
+        self.assertEqual(tab._execute(), ('x', 2))
+        self.assertEqual(Pool.built, 1)
+
+    def test_teardown_when_process_target_finishes(self):
+        tab = Tab('pooled', verbose=False).setup(Pool).teardown(Pool.close).after('up').run(use_pool, 'x')
+        tab._get_trigger_target(None)()
+        tab._get_trigger_target(None)()
+        self.assertEqual((Pool.built, Pool.closed), (2, 2))
+        self.assertFalse(tab._resource_built)
+
+    def test_resource_precedes_upstream_result(self):
+        tab = Tab('pooled', verbose=False).setup(Pool).after('up', pass_result=True).run(use_pool)
+        self.assertEqual(tab._execute(('result',)), ('result', 1))
+
+    def test_fingerprint_ignores_resource(self):
+        tab = Tab('pooled').setup(Pool).every(seconds=1).run(use_pool, 'x')
+        fresh = tab._fingerprint()
+        tab._execute()
+        self.assertEqual(tab._fingerprint(), fresh)
+
+
+class Flaky(object):
+    def __init__(self, failures, exception_class=ExpectedException):
+        self.failures = failures
+        self.exception_class = exception_class
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.exception_class('This exception is expected in tests. Don\'t worry about it.')
+        return 'ok'
+
+
+class TestRetries(TestCase):
+    def make_tab(self, flaky, **kwargs):
+        tab = Tab('flaky', verbose=False, retry_backoff=.01, **kwargs).every(seconds=1).run(flaky)
+        tab._event_queue = queue.Queue()
+        return tab
+
+    def events(self, tab):
+        events = []
+        while not tab._event_queue.empty():
+            events.append(tab._event_queue.get_nowait()[0])
+        return events
+
+    def test_retry_until_success(self):
+        flaky = Flaky(2)
+        tab = self.make_tab(flaky, retries=2)
+        self.assertEqual(tab._execute(), 'ok')
+        self.assertEqual(flaky.calls, 3)
+        self.assertEqual(self.events(tab), ['retry', 'retry'])
+
+    def test_retries_exhausted(self):
+        flaky = Flaky(3)
+        with self.assertRaises(ExpectedException):
+            self.make_tab(flaky, retries=2)._execute()
+        self.assertEqual(flaky.calls, 3)
+
+    def test_retry_on(self):
+        flaky = Flaky(1, exception_class=KeyError)
+        with self.assertRaises(KeyError):
+            self.make_tab(flaky, retries=2, retry_on=ExpectedException)._execute()
+        self.assertEqual(flaky.calls, 1)
+
+    def test_retries_stop_at_deadline(self):
+        flaky = Flaky(3)
+        with self.assertRaises(ExpectedException):
+            self.make_tab(flaky, retries=5)._execute(deadline=time.time() + .025)
+        # waits of .01 then .02 seconds would pass the deadline on the second retry
+        self.assertEqual(flaky.calls, 2)
+
+    def test_robust_loop_retries_and_stats(self):
+        flaky = Flaky(1)
+        tab = self.make_tab(flaky, retries=1)
+        tab._loop(max_iter=1)
+        self.assertEqual(flaky.calls, 2)
+
+        cron = Cron()
+        for kind in self.events(tab):
+            cron._handle_event(kind, 'flaky', None)
+        self.assertEqual(cron.stats(), {'flaky': {'retry': 1, 'success': 1}})
+
+
+def square(*args):
+    value = args[-1]
+    if value < 0:
+        raise ExpectedException('This exception is expected in tests. Don\'t worry about it.')
+    time.sleep(.5 * (value >= 99))
+    return sum(args[:-1]) + value * value
+
+
+FLAKY_CALLS = Counter()
+
+
+def flaky_partition(partition):  # pragma: no cover
+    FLAKY_CALLS[partition] += 1
+    if partition == 'flaky' and FLAKY_CALLS[partition] == 1:
+        raise ConnectionError('first attempt fails')
+    if partition == 'broken':
+        raise ExpectedException('This exception is expected in tests. Don\'t worry about it.')
+    return partition
+
+
+def run_partitions(tab):  # pragma: no cover
+    try:
+        tab._execute()
+    except PartitionError:
+        pass
+
+
+class TestPartitionMap(TestCase):
+    def test_thread_map(self):
+        started = time.time()
+        tab = Tab('mapped', verbose=False).every(seconds=1).map(square, [1, 2, 99, 99 + 1e-9], workers=4)
+        results = tab._execute()
+        self.assertEqual(sorted(results), [1, 2, 99, 99 + 1e-9])
+        self.assertEqual(results[2], 4)
+        # the slow partitions ran at the same time
+        self.assertLess(time.time() - started, 1)
+
+    def test_retries_only_failed_partitions(self):
+        FLAKY_CALLS.clear()
+        tab = Tab('mapped', verbose=False, retries=2, retry_backoff=0).every(seconds=1)
+        results = tab.map(flaky_partition, ['steady', 'flaky'])._execute()
+        self.assertEqual(results, {'steady': 'steady', 'flaky': 'flaky'})
+        self.assertEqual(FLAKY_CALLS, {'steady': 1, 'flaky': 2})
+
+        # partitions that don't fail with a retry_on exception aren't retried
+        FLAKY_CALLS.clear()
+        tab = Tab('mapped', verbose=False, retries=2, retry_backoff=0, retry_on=ConnectionError).every(seconds=1)
+        with self.assertRaises(PartitionError) as context:
+            tab.map(flaky_partition, ['steady', 'flaky', 'broken'])._execute()
+        self.assertEqual(context.exception.results, {'steady': 'steady', 'flaky': 'flaky'})
+        self.assertEqual(list(context.exception.errors), ['broken'])
+        self.assertEqual(FLAKY_CALLS, {'steady': 1, 'flaky': 2, 'broken': 1})
+
+    def test_process_timeout_terminates_workers(self):
+        tab = Tab('mapped', verbose=False).every(seconds=1).map(
+            time.sleep, [30], timeout=.5, executor='process')
+        children = set(multiprocessing.active_children())
+        started = time.time()
+        with self.assertRaises(PartitionError):
+            tab._execute()
+        self.assertLess(time.time() - started, 10)
+        time.sleep(.5)
+        self.assertEqual(set(multiprocessing.active_children()) - children, set())
+
+    def test_tab_process_exits_after_timeout(self):
+        tab = Tab('mapped', verbose=False).every(seconds=1).map(
+            time.sleep, [20], timeout=.2, executor='process')
+        process = multiprocessing.Process(target=run_partitions, args=(tab,))
+        process.start()
+        process.join(8)
+        self.assertFalse(process.is_alive())
+        self.assertEqual(process.exitcode, 0)
+
+    def test_partition_callable_and_extra_args(self):
+        tab = Tab('mapped', verbose=False).setup(lambda: 10).every(seconds=1).map(square, lambda: range(3))
+        self.assertEqual(tab._execute(), {0: 10, 1: 11, 2: 14})
+
+    def test_partition_errors(self):
+        tab = Tab('mapped', verbose=False).every(seconds=1).map(square, [1, -1, 99], timeout=.3, executor='process')
+        with self.assertRaises(PartitionError) as context:
+            tab._execute()
+        error = context.exception
+        self.assertEqual(error.results, {1: 1})
+        self.assertIsInstance(error.errors[-1], ExpectedException)
+        self.assertIsInstance(error.errors[99], concurrent.futures.TimeoutError)
+
+    def test_process_map(self):
+        tab = Tab('mapped', verbose=False).every(seconds=1).map(square, [2, 3], workers=2, executor='process')
+        self.assertTrue(tab._allow_children)
+        self.assertEqual(tab._execute(), {2: 4, 3: 9})
+
+    def test_bad_map_arguments(self):
+        with self.assertRaises(ValueError):
+            Tab('mapped').map(square, [1], executor='bad')
+        with self.assertRaises(ValueError):
+            Tab('mapped').map(square, [1], workers=0)
+        with self.assertRaises(ValueError):
+            Tab('mapped').map(square, [1], timeout=1)
+
+    def test_allow_children(self):
+        cron = Cron().schedule(Tab('mapped', verbose=False).every(seconds=1).map(square, [1], executor='process'))
+        cron._register(cron._tab_list[0])
+        self.assertEqual(cron.monitor._non_daemonic, {'mapped'})
+
+
+class TestOnDemand(TestCase):
+    def test_spawn_time(self):
+        tab = Tab('daily', on_demand=True, lead_seconds=60).every(days=1).run(func)
+        now = datetime.datetime(2020, 1, 1, 12)
+        self.assertEqual(tab._next_fire_time(now), datetime.datetime(2020, 1, 2))
+        self.assertEqual(tab._spawn_time(now), datetime.datetime(2020, 1, 1, 23, 59))
+        # too close to the run to honor the full lead time
+        late = datetime.datetime(2020, 1, 1, 23, 59, 30)
+        self.assertEqual(tab._spawn_time(late), late)
+        self.assertEqual(tab._on_demand_schedule(late), (late, {'fire_time': datetime.datetime(2020, 1, 2)}))
+
+    def test_late_process_runs_its_fire_time(self):
+        tab = Tab('late', verbose=False, on_demand=True).every(minutes=1).run(time_logger, 'late')
+        # the process started after the run it was started for was due
+        fire_time = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        started = time.time()
+        with PrintCatcher() as catcher:
+            tab._get_target()(fire_time=fire_time)
+        self.assertEqual(catcher.text.count('late'), 1)
+        self.assertLess(time.time() - started, 1)
+
+    def test_on_demand_validation(self):
+        with self.assertRaises(ValueError):
+            Tab('fast', on_demand=True).every(milliseconds=100).run(func)._get_target()
+        with self.assertRaises(ValueError):
+            Tab('queued', on_demand=True).on_queue(queue.Queue()).run(func)._get_target()
+
+    def test_not_started_before_spawn_time(self):
+        cron = Cron().schedule(Tab('daily', on_demand=True).every(days=1).run(func))
+        cron._register(cron._tab_list[0])
+        cron.monitor.start_pending()
+        self.assertEqual(cron.monitor._sentinels, {})
+        self.assertEqual(len(cron.monitor._spawn_heap), 1)
+
+    def test_on_demand_processes(self):
+        cron = Cron().schedule(
+            Tab('on_demand', verbose=False, on_demand=True, lead_seconds=.3).every(seconds=2).run(pid_logger)
+        )
+        alive_counts = []
+        cron.monitor.add_hook(lambda: alive_counts.append(len(cron.monitor._sentinels)))
+        with PrintCatcher() as catcher:
+            cron.go(max_seconds=4.5)
+
+        pids = [line for line in catcher.text.split('\n') if line.startswith('pid=')]
+        self.assertIn(len(pids), [2, 3])
+        self.assertEqual(len(set(pids)), len(pids))
+        # most of the time there is no process at all
+        self.assertGreater(alive_counts.count(0), len(alive_counts) / 2)
+
+
+def customer_logger(customer, greeting='hello'):  # pragma: no cover
+    print('{} {}'.format(greeting, customer))
+
+
+class TestScheduleMany(TestCase):
+    def test_spec_builds_tab(self):
+        cron = Cron(max_concurrent_runs=2)
+        template = Tab('customer_{customer}', retries=2).every(hours=1).run(customer_logger, greeting='hi')
+        cron.schedule_many(template, ({'customer': num} for num in range(3)))
+        self.assertEqual(cron.monitor._subprocesses, {})
+
+        cron._register_many(*cron._bulk_list[0])
+        specs = [sub._target for sub in cron.monitor._subprocesses.values()]
+        self.assertEqual([spec.name for spec in specs], ['customer_0', 'customer_1', 'customer_2'])
+        self.assertIs(specs[0].blob, specs[2].blob)
+
+        tab = specs[1].build()
+        self.assertEqual(tab._name, 'customer_1')
+        self.assertEqual(tab._retries, 2)
+        self.assertEqual(tab._func_kwargs, {'greeting': 'hi', 'customer': 1})
+        self.assertIs(tab._admission_event, cron._admission.grant_event('customer_1'))
+        # no monitor is running to grant admission
+        tab._admission_event = None
+        with PrintCatcher() as catcher:
+            tab._execute()
+        self.assertEqual(catcher.text, 'hi 1\n')
+
+    def test_unpicklable_templates(self):
+        template = Tab('lambda_{n}', verbose=False).every(seconds=1).run(lambda n: print('lambda {}'.format(n)))
+        cron = Cron()
+        cron._register_many(template, [{'n': 1}])
+        with PrintCatcher() as catcher:
+            cron.monitor._subprocesses['lambda_1']._target.build()._execute()
+        self.assertEqual(catcher.text, 'lambda 1\n')
+
+        with mock.patch('crontabs.crontabs._forks_processes', return_value=False):
+            with self.assertRaises(ValueError):
+                Cron().schedule_many(template, [{'n': 1}])
+
+    def test_unsupported_templates(self):
+        for template in [
+            Tab('a_{n}', profile='cprofile'),
+            Tab('a_{n}', max_rss_mb=100),
+            Tab('a_{n}').on_queue(queue.Queue()),
+            Tab('a_{n}').after('b'),
+            Tab('a_{n}', on_demand=True),
+        ]:
+            with self.assertRaises(ValueError):
+                Cron().schedule_many(template.every(seconds=1).run(func), [{'n': 1}])
+
+    def test_schedule_many_runs(self):
+        cron = Cron().schedule_many(
+            Tab('customer_{customer}', verbose=False).every(seconds=1).run(customer_logger),
+            ({'customer': name} for name in ['ann', 'bob'])
+        )
+        with PrintCatcher() as catcher:
+            cron.go(max_seconds=2.5)
+        self.assertGreaterEqual(catcher.text.count('hello ann'), 2)
+        self.assertGreaterEqual(catcher.text.count('hello bob'), 2)
+
+
+class TestTimezones(TestCase):
+    def test_parse_cache(self):
+        _parse_date.cache_clear()
+        self.assertEqual(Tab('a').until('2020-01-01 12:00')._until, datetime.datetime(2020, 1, 1, 12))
+        Tab('b').starting('2020-01-01 12:00')
+        self.assertEqual(_parse_date.cache_info().hits, 1)
+
+        # times without a date are on the current day, not the day they were first parsed
+        yesterday = datetime.datetime.combine(datetime.date.today(), datetime.time()) - datetime.timedelta(days=1)
+        self.assertEqual(_parse_date('09:00', yesterday), yesterday.replace(hour=9))
+        self.assertEqual(Tab('c').until('09:00')._until, yesterday.replace(hour=9) + datetime.timedelta(days=1))
+
+    def test_aware_dates(self):
+        tab = Tab('a', tz='America/New_York').until('2020-07-01 12:00+00:00')
+        self.assertEqual(tab._until, datetime.datetime(2020, 7, 1, 8))
+
+    def test_bad_timezone(self):
+        with self.assertRaises(ValueError):
+            Tab('a', tz='Not/A_Zone')
+
+    def test_shared_offset_table(self):
+        first = Tab('a', tz='America/New_York')
+        second = Tab('b', tz='America/New_York')
+        table = first._get_offset_table()
+        self.assertIs(second._get_offset_table(), table)
+        self.assertIs(get_offset_table(get_timezone('America/New_York')), table)
+
+        # looking up a time outside the table extends it rather than moving it
+        start, end = table._start, table._end
+        far = end + 86400 * 366 * 5
+        table.offset(far)
+        self.assertLessEqual(table._start, start)
+        self.assertGreater(table._end, far)
+        with mock.patch.object(table, '_build') as build:
+            table.offset(start)
+            table.offset(far)
+        build.assert_not_called()
+
+    def test_offset_table(self):
+        table = UtcOffsetTable(get_timezone('America/New_York'))
+
+        def to_utc(text):
+            return from_seconds(table.to_utc(to_seconds(parse(text))))
+
+        self.assertEqual(to_utc('2030-01-15 12:00'), datetime.datetime(2030, 1, 15, 17))
+        self.assertEqual(to_utc('2030-07-15 12:00'), datetime.datetime(2030, 7, 15, 16))
+        # skipped wall times run when the clocks go forward
+        self.assertEqual(to_utc('2030-03-10 02:30'), datetime.datetime(2030, 3, 10, 7))
+        # repeated wall times run on their first occurrence
+        self.assertEqual(to_utc('2030-11-03 01:30'), datetime.datetime(2030, 11, 3, 5, 30))
+
+        zone = tz.gettz('America/New_York')
+        for hours in range(0, 24 * 400, 7):
+            utc = datetime.datetime(2030, 1, 1) + datetime.timedelta(hours=hours)
+            expected = utc.replace(tzinfo=tz.UTC).astimezone(zone).replace(tzinfo=None)
+            self.assertEqual(from_seconds(table.to_local(to_seconds(utc))), expected)
+
+    def test_wall_clock(self):
+        tab = Tab('a', tz='Asia/Kolkata')
+        utc_now = datetime.datetime.now(tz.UTC)
+        expected = utc_now.astimezone(tz.gettz('Asia/Kolkata')).replace(tzinfo=None)
+        self.assertLess(abs((tab._now() - expected).total_seconds()), 1)
+        self.assertAlmostEqual(tab._seconds_until(expected + datetime.timedelta(minutes=1)), 60, delta=1)
+
+        local_now = datetime.datetime.now()
+        self.assertLess(abs((tab._from_wall(tab._to_wall(local_now)) - local_now).total_seconds()), 1e-3)
+
+    def test_boundaries_in_timezone(self):
+        tab = Tab('a', tz='Asia/Kolkata').every(days=1)
+        # noon UTC in the local timezone of the machine
+        local_now = datetime.datetime(2030, 1, 15, 12, tzinfo=tz.UTC).astimezone().replace(tzinfo=None)
+        spawn_time = tab._spawn_time(local_now)
+        # the next day starts at midnight in Kolkata, which is 18:30 UTC
+        self.assertEqual(spawn_time.astimezone(tz.UTC), datetime.datetime(2030, 1, 15, 18, 29, 55, tzinfo=tz.UTC))
+
+    def test_loop_steps_in_utc_across_clock_change(self):
+        def sleeps_from(utc_now, **every):
+            tab = Tab('a', tz='America/New_York').every(**every).run(func)
+            sleeps = []
+            with mock.patch('time.time', return_value=utc_now.timestamp()), \
+                    mock.patch.object(tab, '_sleep', side_effect=lambda s, n: sleeps.append(s)):
+                tab._loop(max_iter=1)
+            return sleeps[0]
+
+        # 01:59:30 EDT, half a minute before the clocks go back to 01:00 EST
+        fall_back = datetime.datetime(2030, 11, 3, 5, 59, 30, tzinfo=tz.UTC)
+        self.assertAlmostEqual(sleeps_from(fall_back, minutes=1), 30)
+        self.assertAlmostEqual(sleeps_from(fall_back, hours=1), 30)
+        # 01:59:30 EST, half a minute before the clocks go forward to 03:00 EDT
+        spring_forward = datetime.datetime(2030, 3, 10, 6, 59, 30, tzinfo=tz.UTC)
+        self.assertAlmostEqual(sleeps_from(spring_forward, minutes=1), 30)
+        # 01:30 EST, the second time the wall clock shows 01:30 that night
+        repeated = datetime.datetime(2030, 11, 3, 6, 30, tzinfo=tz.UTC)
+        self.assertAlmostEqual(sleeps_from(repeated, minutes=15), 15 * 60)
+        # daily tabs still run at wall clock midnight, 25 hours after the previous one
+        tab = Tab('a', tz='America/New_York').every(days=1)
+        self.assertEqual(tab._next_fire_time(datetime.datetime(2030, 11, 3, 12)), datetime.datetime(2030, 11, 4))
+
+    def test_runs_in_timezone(self):
+        cron = Cron().schedule(
+            Tab('a', tz='Pacific/Chatham', verbose=False).every(seconds=1).lasting(seconds=2.5).run(func)
+        )
+        with PrintCatcher() as catcher:
+            cron.go(max_seconds=3)
+        self.assertIn(catcher.text.count('func_was_called'), [2, 3])
@@ -0,0 +1,120 @@
+"""
+Cheap conversions between UTC and the wall time of a timezone
+"""
+import bisect
+import datetime
+import time
+
+from dateutil import tz as dateutil_tz
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def get_timezone(name_or_tzinfo):
+    """
+    Returns a tzinfo for a timezone name like "America/New_York" or a tzinfo object
+    """
+    if isinstance(name_or_tzinfo, datetime.tzinfo):
+        return name_or_tzinfo
+    tzinfo = dateutil_tz.gettz(name_or_tzinfo)
+    if tzinfo is None:
+        raise ValueError('Unknown timezone {!r}'.format(name_or_tzinfo))
+    return tzinfo
+
+
+def to_seconds(naive_datetime):
+    """
+    Returns the seconds since the epoch of a naive datetime as a float
+    """
+    return (naive_datetime - EPOCH).total_seconds()
+
+
+def from_seconds(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+# Offset tables by the repr of their tzinfo, since dateutil timezones aren't hashable
+_offset_tables = {}
+
+
+def get_offset_table(tzinfo):
+    """
+    Returns the UtcOffsetTable of a timezone.  Tables are shared by every tab in a process,
+    and forked tab processes inherit the tables already built by their parent.
+    """
+    key = repr(tzinfo)
+    if key not in _offset_tables:
+        _offset_tables[key] = UtcOffsetTable(tzinfo)
+    return _offset_tables[key]
+
+
+class UtcOffsetTable(object):
+    # Offsets are sampled this many seconds apart and transitions found by bisection,
+    # so transitions less than a day apart are not resolved
+    SCAN_SECONDS = 86400
+    # How far around a requested time the table is built
+    PAST_SECONDS = 86400 * 366
+    FUTURE_SECONDS = 86400 * 366 * 2
+
+    def __init__(self, tzinfo):
+        """
+        Holds the UTC offsets of a timezone as a sorted table of transitions, so converting
+        a time only needs a bisection over integers.  The table covers a few years around
+        the current time and is extended whenever a time outside of it is looked up.
+        Use get_offset_table() to share tables rather than building them here.
+        """
+        self._tzinfo = tzinfo
+        now = int(time.time())
+        self._build(now - self.PAST_SECONDS, now + self.FUTURE_SECONDS)
+
+    def _offset_at(self, utc_seconds):
+        utc = datetime.datetime.fromtimestamp(utc_seconds, dateutil_tz.UTC)
+        return int(utc.astimezone(self._tzinfo).utcoffset().total_seconds())
+
+    def _build(self, start, end):
+        transitions, offsets = [start], [self._offset_at(start)]
+        for probe in range(start + self.SCAN_SECONDS, end + self.SCAN_SECONDS, self.SCAN_SECONDS):
+            offset = self._offset_at(probe)
+            if offset == offsets[-1]:
+                continue
+            # find the first second with the new offset
+            low, high = probe - self.SCAN_SECONDS, probe
+            while high - low > 1:
+                middle = (low + high) // 2
+                if self._offset_at(middle) == offset:
+                    high = middle
+                else:
+                    low = middle
+            transitions.append(high)
+            offsets.append(offset)
+        self._start, self._end = start, end
+        self._transitions, self._offsets = transitions, offsets
+
+    def offset(self, utc_seconds):
+        """
+        Returns the UTC offset in seconds in effect at utc_seconds
+        """
+        if not self._start <= utc_seconds < self._end:
+            self._build(
+                min(self._start, int(utc_seconds) - self.PAST_SECONDS),
+                max(self._end, int(utc_seconds) + self.FUTURE_SECONDS),
+            )
+        return self._offsets[bisect.bisect_right(self._transitions, utc_seconds) - 1]
+
+    def to_local(self, utc_seconds):
+        return utc_seconds + self.offset(utc_seconds)
+
+    def to_utc(self, local_seconds):
+        """
+        Returns the UTC seconds of a wall time.  Wall times that happen twice when clocks go
+        back resolve to the first occurrence.  Wall times skipped when clocks go forward
+        resolve to the moment the clocks changed.
+        """
+        # offsets never change by more than a day, so the offsets a day either side bracket the answer
+        before = self.offset(local_seconds - 86400)
+        after = self.offset(local_seconds + 86400)
+        candidates = [local_seconds - o for o in (before, after) if self.offset(local_seconds - o) == o]
+        if candidates:
+            return min(candidates)
+        # the wall time was skipped, so use the moment the clocks changed
+        return self._transitions[bisect.bisect_right(self._transitions, local_seconds - after)]
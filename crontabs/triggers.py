@@ -0,0 +1,277 @@
+"""
+Sources of events that can trigger a tab instead of a clock interval
+"""
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+try:  # pragma: no cover
+    from Queue import Empty
+except:  # noqa  pragma: no cover
+    from queue import Empty
+
+
+class Inotify:
+    """
+    A minimal ctypes wrapper around the Linux inotify API
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    # reported when a watch is removed, for example because its directory was deleted
+    IN_IGNORED = 0x00008000
+    CHANGE_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    _EVENT_HEADER = struct.Struct('iIII')
+    _libc = None
+
+    @classmethod
+    def _get_libc(cls):
+        if cls._libc is None:
+            cls._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return cls._libc
+
+    @classmethod
+    def is_available(cls):
+        if not sys.platform.startswith('linux'):  # pragma: no cover
+            return False
+        try:
+            return hasattr(cls._get_libc(), 'inotify_init1')
+        except OSError:  # pragma: no cover
+            return False
+
+    def __init__(self):
+        libc = self._get_libc()
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self._fd < 0:  # pragma: no cover
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask=CHANGE_MASK):
+        wd = self._get_libc().inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds for events and return them as a list of (wd, mask, name) tuples
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:  # pragma: no cover
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class Trigger:
+    """
+    Base class for trigger sources.  wait() blocks for up to timeout seconds and returns a
+    (possibly empty) list of events that happened.
+    """
+    def wait(self, timeout):  # pragma: no cover
+        raise NotImplementedError
+
+    def merge(self, events):
+        return events
+
+    def close(self):
+        pass
+
+
+class PathTrigger(Trigger):
+    def __init__(self, path, poll_seconds=1, use_inotify=None):
+        """
+        Reports changes to a path.  Uses inotify when available and otherwise
+        compares stat() results every poll_seconds.  A watched directory that doesn't
+        exist is looked for every poll_seconds, and its entries are reported once it appears.
+        """
+        self._path = os.path.abspath(path)
+        self._poll_seconds = poll_seconds
+        self._inotify = None
+        if use_inotify is None:
+            use_inotify = Inotify.is_available()
+        if use_inotify:
+            self._inotify = Inotify()
+            self._watching = self._add_watch()
+        else:
+            self._index = self._build_index()
+
+    def _add_watch(self):
+        """
+        Returns True if the watched directory exists and is now watched
+        """
+        try:
+            self._inotify.add_watch(self._watched_directory())
+        except OSError as error:
+            if error.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return False
+        return True
+
+    def _watched_directory(self):  # pragma: no cover
+        raise NotImplementedError
+
+    def _build_index(self):  # pragma: no cover
+        raise NotImplementedError
+
+    def _events_from_inotify(self, names):  # pragma: no cover
+        raise NotImplementedError
+
+    def _diff_index(self, old, new):
+        return [
+            os.path.join(self._watched_directory(), name)
+            for name in sorted(set(old) | set(new)) if old.get(name) != new.get(name)
+        ]
+
+    def merge(self, events):
+        # a path that changed several times is only reported once
+        return list(OrderedDict.fromkeys(events))
+
+    def _poll(self):
+        index = self._build_index()
+        events = self._diff_index(self._index, index)
+        self._index = index
+        return events
+
+    def _wait_for_directory(self, timeout):
+        ends = time.time() + timeout
+        while not self._add_watch():
+            remaining = ends - time.time()
+            if remaining <= 0:
+                return []
+            time.sleep(min(self._poll_seconds, remaining))
+        self._watching = True
+        # like polling, report what is in a directory that appeared as created
+        return self._diff_index({}, self._build_index())
+
+    def wait(self, timeout):
+        if self._inotify is not None:
+            if not self._watching:
+                return self._wait_for_directory(timeout)
+            events = self._inotify.read(timeout)
+            if any(mask & Inotify.IN_IGNORED for (_, mask, _) in events):
+                # the watched directory was removed, so look for it to come back
+                self._watching = False
+            return self._events_from_inotify([name for (_, _, name) in events])
+
+        ends = time.time() + timeout
+        while True:
+            events = self._poll()
+            remaining = ends - time.time()
+            if events or remaining <= 0:
+                return events
+            time.sleep(min(self._poll_seconds, remaining))
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+
+def _stat_key(stat_result):
+    return (stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino)
+
+
+class FileTrigger(PathTrigger):
+    """
+    Reports changes to a single file, including it being created, replaced or deleted.
+    The parent directory is watched so that atomic replacements are seen.
+    """
+    def _watched_directory(self):
+        return os.path.dirname(self._path)
+
+    def _build_index(self):
+        try:
+            return {os.path.basename(self._path): _stat_key(os.stat(self._path))}
+        except OSError:
+            return {}
+
+    def _events_from_inotify(self, names):
+        return [self._path] if os.path.basename(self._path) in names else []
+
+
+class DirectoryTrigger(PathTrigger):
+    """
+    Reports files in a directory (not its subdirectories) that are created, modified or removed.
+    Polling keeps an index of entry metadata so only entries that changed are reported.
+    """
+    def _watched_directory(self):
+        return self._path
+
+    def _build_index(self):
+        index = {}
+        try:
+            for entry in os.scandir(self._path):
+                try:
+                    index[entry.name] = _stat_key(entry.stat())
+                except OSError:  # pragma: no cover  the entry was removed while scanning
+                    pass
+        except OSError:
+            pass
+        return index
+
+    def _events_from_inotify(self, names):
+        return [os.path.join(self._path, name) for name in names if name]
+
+
+class QueueTrigger(Trigger):
+    def __init__(self, q):
+        """
+        Reports every message put on a queue
+        """
+        self._q = q
+
+    def wait(self, timeout):
+        try:
+            events = [self._q.get(timeout=timeout)]
+        except Empty:
+            return []
+        while True:
+            try:
+                events.append(self._q.get_nowait())
+            except Empty:
+                return events
+
+
+def coalesce(trigger, events, debounce_seconds, max_delay_seconds):
+    """
+    Keep collecting events until none arrive for debounce_seconds or max_delay_seconds
+    have passed, so a burst of events results in a single run.
+    """
+    ends = time.time() + max_delay_seconds
+    while debounce_seconds > 0:
+        remaining = ends - time.time()
+        if remaining <= 0:
+            break
+        more = trigger.wait(min(debounce_seconds, remaining))
+        if not more:
+            break
+        events.extend(more)
+    return trigger.merge(events)